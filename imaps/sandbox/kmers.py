@@ -56,26 +56,32 @@ for each cluster over a larger window is drawn. All the figures and several
 tables are saved and available for inspection.
 """
 
+import argparse
 import os
-from itertools import product, combinations
+from itertools import product
 from collections import OrderedDict
+from contextlib import ExitStack
+from functools import partial
 import csv
+import fcntl
+import glob
 import random
 from random import randint
 import shutil
-import gzip
-import copy
+import hashlib
+import json
+import multiprocessing
+import tempfile
 import time
+import traceback
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import pybedtools as pbt
-import seaborn as sns
-from sklearn.cluster import KMeans
+from scipy.signal import get_window
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 from sklearn.decomposition import PCA
 from plumbum import local
-from plumbum.cmd import zcat, sort
 import scipy
 
 REGIONS = [
@@ -99,23 +105,38 @@ REGION_SITES = {
     'UTR5': ['UTR5']
 }
 REGIONS_QUANTILE = ['intron', 'intergenic', 'cds_utr_ncrna']
-REGIONS_MAP = {}
-TEMP_PATH = None
-
-
-# overriding pybedtools to_dataframe method to avoid warning
-def to_dataframe_fixed(self, *args, **kwargs):
-    """
-    Create a pandas.DataFrame, passing args and kwargs to pandas.read_csv.
-
-    This function overrides pybedtools function to avoid FutureWarning:
-    read_table is deprecated, use read_csv instead... Pandas must be
-    imported as pd, it is advisable to specify dtype and names as well.
-    """
-    return pd.read_csv(self.fn, header=None, sep='\t', *args, **kwargs)
-
-
-pbt.BedTool.to_dataframe = to_dataframe_fixed  # required for overriding
+STRANDS = ['+', '-']
+NULL_MODELS = ['bootstrap', 'analytic', 'check']
+TABLE_FORMATS = ['tsv', 'binary', 'both']
+RESULT_COLUMNS = ['artxn', 'aroxn', 'etxn', 'z-score', 'p-value']
+SHARD_COLUMNS = [None, 'chrom', 'strand']
+WORKER_CONTEXT = None
+# 2-bit codes of nucleotides, any other character (including soft-masked
+# lowercase bases) gets INVALID_BASE code and positions after the end of
+# shorter sequences are filled with PADDING
+INVALID_BASE = 4
+PADDING = 5
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+BASE_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, INVALID_BASE, PADDING], dtype=np.uint8)
+# number of sequences processed at once by the counting engine
+CHUNK_SIZE = 10000
+# cache of results reused across runs and its maximal size in bytes
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'imaps')
+CACHE_SIZE = 2 * 1024 ** 3
+# version of stores of arrays derived from input files, stores with other
+# versions are rebuilt
+STORE_VERSION = 1
+# memory used for parsing BED files and approximate memory used for parsing
+# a single line of BED file
+MEMORY_BUDGET = 2 ** 30
+SITE_BYTES = 256
+# number of kmers above which randomized PCA and mini-batch k-means are
+# used for clustering, maximal number of clusters tried when it is chosen
+# automatically and number of kmers on which silhouette score is estimated
+LARGE_CLUSTERING = 200
+MAX_CLUSTERS = 10
+SILHOUETTE_SAMPLE = 2000
 
 
 def get_name(s_file):
@@ -123,14 +144,23 @@ def get_name(s_file):
     return s_file.split('/')[-1].replace('.gz', '').replace('.bed', "").replace('.xl', "")
 
 
-def parse_bed6_to_df(p_file):
-    """Parse BED6 file to pandas.DataFrame."""
-    return pd.read_csv(
-        p_file,
+def read_bed6_chunks(bed_file, memory_budget=MEMORY_BUDGET):
+    """Yield chunks of BED6 file (can be gzipped) as DataFrames with compact types.
+
+    Number of lines in a chunk is chosen so that parsing a chunk uses about
+    ``memory_budget`` bytes. Chromosome, name and strand are categorical,
+    positions int32 and scores float32.
+    """
+    reader = pd.read_csv(
+        bed_file,
         names=['chrom', 'start', 'end', 'name', 'score', 'strand'],
         sep='\t',
         header=None,
-        dtype={'chrom': str, 'start': int, 'end': int, 'name': str, 'score': float, 'strand': str})
+        dtype={
+            'chrom': 'category', 'start': np.int32, 'end': np.int32, 'name': 'category', 'score': np.float32,
+            'strand': 'category'},
+        chunksize=max(memory_budget // SITE_BYTES, 1))
+    yield from reader
 
 
 def parse_region_to_df(region_file):
@@ -166,22 +196,82 @@ def filter_intron(df_in, min_size):
 
 
 def get_regions_map(regions_file):
-    """Prepare temporary files based on GTF file that defines regions."""
-    df_regions = pd.read_csv(
-        regions_file, sep='\t', header=None,
-        names=['chrom', 'second', 'region', 'start', 'end', 'sixth', 'strand', 'eighth', 'id_name_biotype'],
-        dtype={
-            'chrom': str, 'second': str, 'region': str, 'start': int, 'end': int, 'sixth': str, 'strand': str,
-            'eight': str, 'id_name_biotype': str})
+    """Get regions used for thresholding from GTF file that defines regions."""
+    df_regions = parse_region_to_df(regions_file)
     df_intergenic = df_regions.loc[df_regions['region'] == 'intergenic']
     df_cds_utr_ncrna = df_regions.loc[df_regions['region'].isin(['CDS', 'UTR3', 'UTR5', 'ncRNA'])]
     df_intron = df_regions.loc[df_regions['region'] == 'intron']
     df_cds_utr_ncrna = filter_cds_utr_ncrna(df_cds_utr_ncrna)
     df_intron = filter_intron(df_intron, 100)
-    to_csv_kwrgs = {'sep': '\t', 'header': None, 'index': None}
-    df_intron.to_csv('{}intron_regions.bed'.format(TEMP_PATH), **to_csv_kwrgs)
-    df_intergenic.to_csv('{}intergenic_regions.bed'.format(TEMP_PATH), **to_csv_kwrgs)
-    df_cds_utr_ncrna.to_csv('{}cds_utr_ncrna_regions.bed'.format(TEMP_PATH), **to_csv_kwrgs)
+    return {'intron': df_intron, 'intergenic': df_intergenic, 'cds_utr_ncrna': df_cds_utr_ncrna}
+
+
+def encode_names(names):
+    """Encode strings as bytes, so they can be stored in memory-mappable arrays."""
+    return np.array([name.encode() for name in names], dtype=bytes)
+
+
+def decode_names(names):
+    """Decode array of bytes to list of strings."""
+    return [name.decode() for name in names.tolist()]
+
+
+def compile_annotation(regions_file):
+    """Compile regions used for thresholding into arrays.
+
+    For each of the ``REGIONS_QUANTILE`` families, intervals (already
+    filtered and trimmed) are sorted by chromosome, strand and start and
+    stored as arrays of keys of starts and ends (see ``get_interval_keys``),
+    together with codes of their features, genes and attributes. Intervals
+    in GTF are 1-based, so CDS, UTR and ncRNA intervals are stored as 0-based
+    [start - 1, end). Intron and intergenic intervals are stored as
+    [start, end), as when peak intervals were obtained with pandas cut.
+    """
+    regions_map = get_regions_map(regions_file)
+    df_all = pd.concat(regions_map.values(), ignore_index=True)
+    chroms = pd.unique(df_all['chrom'])
+    features = pd.unique(df_all['region'])
+    attributes = pd.unique(df_all['id_name_biotype'])
+    gene_codes, genes = pd.factorize(get_gene_names(regions_map['cds_utr_ncrna']['id_name_biotype'].values))
+    arrays = {
+        'chroms': encode_names(chroms),
+        'features': encode_names(features),
+        'attributes': encode_names(attributes),
+        'genes': encode_names(genes),
+    }
+    for family, df_region in regions_map.items():
+        starts = df_region['start'].values - 1 if family == 'cds_utr_ncrna' else df_region['start'].values
+        chrom_codes = pd.Index(chroms).get_indexer(df_region['chrom'].values)
+        strand_codes = pd.Index(STRANDS).get_indexer(df_region['strand'].values)
+        start_keys = get_interval_keys(chrom_codes, strand_codes, starts)
+        order = np.argsort(start_keys, kind='mergesort')
+        arrays[family + '_starts'] = start_keys[order]
+        arrays[family + '_ends'] = get_interval_keys(chrom_codes, strand_codes, df_region['end'].values)[order]
+        arrays[family + '_features'] = pd.Index(features).get_indexer(df_region['region'].values)[order]
+        arrays[family + '_attributes'] = pd.Index(attributes).get_indexer(df_region['id_name_biotype'].values)[order]
+        if family == 'cds_utr_ncrna':
+            arrays[family + '_genes'] = gene_codes[order]
+        else:
+            arrays[family + '_genes'] = np.full(len(order), -1, dtype=np.int64)
+    return arrays
+
+
+def get_annotation_index(regions_file, cache_dir=CACHE_DIR):
+    """Return compiled regions used for thresholding.
+
+    Compiled regions are stored next to the regions file and reused as long
+    as checksum of the regions file does not change.
+    """
+    path = get_store_path(regions_file, '.index', cache_dir)
+    meta = {'sha1': get_file_hash(regions_file)}
+    annotation = load_store(path, meta)
+    if annotation is None:
+        print(f'Compiling regions {regions_file} to {path}')
+        save_store(path, compile_annotation(regions_file), meta)
+        annotation = load_store(path, meta)
+    for name in ['chroms', 'features', 'attributes', 'genes']:
+        annotation[name] = decode_names(annotation[name])
+    return annotation
 
 
 def remove_chr(df_in, chr_sizes, chr_name='chrM'):
@@ -195,134 +285,572 @@ def remove_chr(df_in, chr_sizes, chr_name='chrM'):
     return df_in[~(df_in['chrom'] == chr_name)]
 
 
-def intersect(interval_file, s_file):
-    """Intersect two BED files and return resulting BED file."""
-    if interval_file:
-        result = pbt.BedTool(s_file).intersect(
-            pbt.BedTool(interval_file), s=True,
-            nonamecheck=True,
-        ).saveas()
-    else:
-        result = pbt.BedTool(s_file)
-    if len(result) >= 1:
-        return result
+def get_reference(df_xn, complement):
+    """Return crosslinks that are in complement of peaks on the same strand.
 
+    Crosslinks are assigned to gaps in ``complement`` (see
+    ``get_complement``) with a single sorted search on their start
+    positions. Index of ``df_xn`` is kept, so the order of crosslinks can be
+    restored after they are split into shards (see ``sum_shards_counts``).
+    """
+    keys = get_interval_keys(
+        get_name_codes(df_xn['chrom'].values, complement['chroms']),
+        get_name_codes(df_xn['strand'].values, STRANDS), df_xn['start'].values)
+    in_complement = find_intervals(keys, complement['start_keys'], complement['end_keys']) >= 0
+    return df_xn[in_complement]
+
+
+def get_complement(interval_file, chrsizes_file, cache_dir=CACHE_DIR, memory_budget=MEMORY_BUDGET):
+    """Return complement of peaks on each strand.
+
+    Complement is a dictionary with sorted names of chromosomes in
+    chromosome sizes file (chroms) and sorted interval keys (see
+    ``get_interval_keys``) of starts and ends of gaps between peaks on the
+    same chromosome and strand (start_keys, end_keys). Gaps of all
+    chromosomes and both strands are obtained at once from sorted peaks
+    (see ``get_bed_store``). Peaks on chromosomes not in chromosome sizes
+    file and on chrM are ignored (see ``remove_chr``).
+    """
+    df_chr_sizes = pd.read_csv(
+        chrsizes_file, names=['chrom', 'end'], sep='\t', header=None, dtype={'chrom': str, 'end': int})
+    df_chr_sizes = df_chr_sizes.sort_values(by='chrom', kind='mergesort')
+    chroms = np.array(df_chr_sizes['chrom'].tolist(), dtype=str)
+    chrom_sizes = df_chr_sizes['end'].values.astype(np.int64)
+    peaks = get_bed_store(interval_file, cache_dir, memory_budget)
+    chrom_map = get_name_codes(np.where(peaks['chroms'] == 'chrM', '', peaks['chroms']), chroms)
+    strand_map = np.append(get_name_codes(peaks['strands'], STRANDS), -1)
+    chrom_codes = np.repeat(chrom_map, np.diff(peaks['chrom_offsets']))
+    strand_codes = strand_map[peaks['strand_codes']]
+    valid = (chrom_codes >= 0) & (strand_codes >= 0)
+    groups = (chrom_codes * len(STRANDS) + strand_codes)[valid]
+    starts = peaks['start'][valid].astype(np.int64)
+    ends = peaks['end'][valid].astype(np.int64)
+    order = np.lexsort((starts, groups))
+    groups, starts, ends = groups[order], starts[order], ends[order]
+    # gaps end at each peak and start at the furthest end of preceding peaks of the same group
+    covered = np.maximum.accumulate(groups * 2 ** 32 + ends) if len(groups) else np.array([], np.int64)
+    group_sizes = np.repeat(chrom_sizes, len(STRANDS))
+    gap_groups = [groups]
+    gap_starts = [np.maximum(np.append(-1, covered[:-1]) - groups * 2 ** 32, 0)]
+    gap_ends = [np.minimum(starts, group_sizes[groups])]
+    # the last gap of each group extends to the end of chromosome
+    group_ends = np.zeros(len(group_sizes), dtype=np.int64)
+    np.maximum.at(group_ends, groups, ends)
+    gap_groups.append(np.arange(len(group_sizes)))
+    gap_starts.append(group_ends)
+    gap_ends.append(group_sizes)
+    gap_groups, gap_starts, gap_ends = [np.concatenate(arrays) for arrays in [gap_groups, gap_starts, gap_ends]]
+    gaps = gap_ends > gap_starts
+    start_keys = gap_groups[gaps] * 2 ** 32 + gap_starts[gaps]
+    order = np.argsort(start_keys, kind='mergesort')
+    return {
+        'chroms': chroms,
+        'start_keys': start_keys[order],
+        'end_keys': (gap_groups[gaps] * 2 ** 32 + gap_ends[gaps])[order],
+    }
+
+
+def get_file_hash(file_name):
+    """Return SHA1 hash of file content."""
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def evict_cache(cache_dir, cache_size):
+    """Remove least recently used files until cache is smaller than cache_size."""
+    files = [entry for entry in os.scandir(cache_dir) if entry.is_file()]
+    total_size = sum(entry.stat().st_size for entry in files)
+    for entry in sorted(files, key=lambda x: x.stat().st_mtime):
+        if total_size <= cache_size:
+            break
+        total_size -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def get_complement_cached(interval_file, chrsizes_file, cache_dir=CACHE_DIR, cache_size=CACHE_SIZE):
+    """Return complement of peaks, reusing it from cache when possible.
+
+    Cached complements are stored in ``cache_dir`` under the hash of peaks
+    and chromosome sizes file contents. Least recently used complements
+    are removed when cache grows over ``cache_size`` bytes. If cache_dir is
+    not given, complement is computed without caching.
+    """
+    if cache_dir is None:
+        return get_complement(interval_file, chrsizes_file, cache_dir)
+    complement_dir = os.path.join(cache_dir, 'complement')
+    key = hashlib.sha1((get_file_hash(interval_file) + get_file_hash(chrsizes_file)).encode()).hexdigest()
+    cached_file = os.path.join(complement_dir, '{}.npz'.format(key))
+    if os.path.isfile(cached_file):
+        # update modification time to mark complement as recently used
+        os.utime(cached_file)
+        with np.load(cached_file) as cached:
+            return dict(cached)
+    complement = get_complement(interval_file, chrsizes_file, cache_dir)
+    os.makedirs(complement_dir, exist_ok=True)
+    temp_file = '{}.{}.TEMPORARY'.format(cached_file, os.getpid())
+    with open(temp_file, 'wb') as file:
+        np.savez(file, **complement)
+    os.replace(temp_file, cached_file)
+    evict_cache(complement_dir, cache_size)
+    return complement
+
+
+def get_file_stamp(file_name):
+    """Return size and modification time of a file."""
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def get_store_path(file_name, suffix, cache_dir=CACHE_DIR):
+    """Return path of a store of arrays derived from a file.
+
+    Store is placed next to the file, or in the cache directory when the
+    directory of the file is not writable.
+    """
+    file_name = os.path.abspath(file_name)
+    if os.access(os.path.dirname(file_name), os.W_OK):
+        return file_name + suffix
+    key = hashlib.sha1(file_name.encode()).hexdigest()
+    return os.path.join(cache_dir or tempfile.gettempdir(), 'stores', key + suffix)
 
-def get_complement(interval_file, chrsizes_file):
-    """Return BED file containing complement of peaks."""
-    if '.gz' in interval_file:
-        try:
-            with gzip.open(interval_file, 'rb') as file:
-                file.read()
-        except OSError:
-            print('{} has .gz in path/name but seems to not be gzipped')
+
+def get_store_meta(path):
+    """Return metadata of a store, None if store does not exist."""
+    try:
+        with open(os.path.join(path, 'meta.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return
+
+
+def update_store_meta(path, meta):
+    """Replace metadata of an existing store."""
+    temp_file = os.path.join(path, 'meta.json.{}.TEMPORARY'.format(os.getpid()))
+    with open(temp_file, 'w') as file:
+        json.dump(dict(meta, version=STORE_VERSION), file)
+    os.replace(temp_file, os.path.join(path, 'meta.json'))
+
+
+def load_store(path, meta, mmap_mode='r'):
+    """Return memory-mapped arrays of a store.
+
+    If store does not exist or was created with different metadata (e.g.
+    from a file that has changed since), None is returned. None is also
+    returned if a stale store is removed by another process while loading.
+    """
+    stored_meta = get_store_meta(path)
+    if stored_meta != json.loads(json.dumps(dict(meta, version=STORE_VERSION))):
+        return
+    try:
+        return {
+            name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+            for name in os.listdir(path) if name.endswith('.npy')}
+    except OSError:
+        return
+
+
+def create_store(path):
+    """Create temporary directory in which arrays of a new store are written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.TEMPORARY', dir=os.path.dirname(path))
+
+
+def finish_store(temp_path, path, meta):
+    """Write store metadata and move store from temporary directory to path.
+
+    Existing store is replaced only if it has different metadata (e.g. it
+    was created from a file that has changed since). If the same store was
+    created by another process in the meantime, it is kept and the
+    temporary directory is removed, so stores that other processes may be
+    loading are never deleted.
+    """
+    with open(os.path.join(temp_path, 'meta.json'), 'w') as file:
+        json.dump(dict(meta, version=STORE_VERSION), file)
+    directory = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        # stores in a directory are replaced under a lock on it, so that
+        # checking and replacing an existing store is not interleaved
+        # with other processes
+        fcntl.flock(directory, fcntl.LOCK_EX)
+        if get_store_meta(path) == get_store_meta(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        if os.path.isdir(path):
+            # stale store is moved aside before it is removed, so that path
+            # never holds a partially removed store
+            stale_path = tempfile.mkdtemp(
+                prefix=os.path.basename(path) + '.', suffix='.STALE', dir=os.path.dirname(path))
+            os.rename(path, os.path.join(stale_path, 'store'))
+            shutil.rmtree(stale_path, ignore_errors=True)
+        os.rename(temp_path, path)
+    finally:
+        os.close(directory)
+
+
+def save_store(path, arrays, meta):
+    """Save dictionary of arrays as a store."""
+    temp_path = create_store(path)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_path, '{}.npy'.format(name)), array)
+    finish_store(temp_path, path, meta)
+
+
+def encode_categories(values, categories):
+    """Return codes of categorical values in a growing list of categories.
+
+    Categories of values that are not yet in ``categories`` are appended to
+    it. Missing values get code -1.
+    """
+    known = set(categories)
+    categories.extend(category for category in values.categories if category not in known)
+    codes = np.append(pd.Index(categories).get_indexer(values.categories), -1)
+    return codes[values.codes].astype(np.int32)
+
+
+def sort_categories(categories):
+    """Return map of codes to codes in sorted categories and sorted categories.
+
+    Map is indexed by old codes and maps missing value code -1 to itself.
+    """
+    order = np.argsort(np.array(categories, dtype=object), kind='mergesort') if categories else np.array([], int)
+    code_map = np.empty(len(categories) + 1, dtype=np.int32)
+    code_map[order] = np.arange(len(categories))
+    code_map[-1] = -1
+    return code_map, [categories[i] for i in order]
+
+
+def get_sort_keys(chrom_codes, starts, strand_codes):
+    """Return int64 keys that order intervals by chromosome, start and strand codes."""
+    return (
+        (chrom_codes.astype(np.int64) + 1) << 40
+        | starts.astype(np.int64) << 8
+        | (strand_codes.astype(np.int64) + 1))
+
+
+def is_sorted(keys):
+    """Return True if keys are in non-decreasing order."""
+    return bool(np.all(keys[1:] >= keys[:-1]))
+
+
+def merge_runs(runs, block_size):
+    """Yield blocks of merged sorted runs of keys.
+
+    Each block is a pair of arrays with run and index in run of the next
+    keys in merged order. At most ``block_size`` keys of each run are read
+    at a time, so runs can be memory-mapped arrays larger than memory.
+    Equal keys are ordered by run and index in run, as by stable sort of
+    concatenated runs.
+    """
+    positions = [0] * len(runs)
+    while True:
+        active = [i for i, run in enumerate(runs) if positions[i] < len(run)]
+        if not active:
             return
-        interval_file_name = interval_file.split('/')[-1].replace('.gz', "")
-        temp_file_interval = '{}{}.TEMPORARY'.format(TEMP_PATH, interval_file_name)
-        get_sorted = (zcat[interval_file] | sort['-k1,1', '-k2,2n', '-k3,3n'])
-        sorted_interval = get_sorted()
-        with open(temp_file_interval, 'w') as file:
-            file.write(sorted_interval)
+        blocks = [np.asarray(runs[i][positions[i]:positions[i] + block_size]) for i in active]
+        keys = np.concatenate(blocks)
+        run_ids = np.repeat(active, [len(block) for block in blocks])
+        indices = np.concatenate([
+            np.arange(positions[i], positions[i] + len(block)) for i, block in zip(active, blocks)])
+        order = np.lexsort((run_ids, keys))
+        # only keys up to the smallest last read key of unfinished runs are in final order
+        bounds = [(block[-1], i) for i, block in zip(active, blocks) if positions[i] + len(block) < len(runs[i])]
+        if bounds:
+            bound_key, bound_run = min(bounds)
+            merged = (keys < bound_key) | ((keys == bound_key) & (run_ids <= bound_run))
+            order = order[merged[order]]
+        run_ids, indices = run_ids[order], indices[order]
+        for i in active:
+            positions[i] += np.count_nonzero(run_ids == i)
+        yield run_ids, indices
+
+
+def convert_bed(bed_file, path, meta, memory_budget=MEMORY_BUDGET):
+    """Convert BED6 file to a columnar store.
+
+    Intervals are stored sorted by chromosome, start and strand in typed
+    arrays: int32 start and end, float32 score and int32 codes of name and
+    strand with their sorted names. Intervals of the i-th of the sorted
+    chromosome names are at indices from ``chrom_offsets[i]`` to
+    ``chrom_offsets[i + 1]``.
+
+    BED file is read in chunks (see ``read_bed6_chunks``), which are sorted
+    separately as runs. Runs are then merged into the store, so sorting a
+    file of any size uses about ``memory_budget`` bytes. If the file is
+    already sorted, merging is skipped and runs are just copied.
+    """
+    temp_path = create_store(path)
+    dtypes = {
+        'chrom': np.int32, 'start': np.int32, 'end': np.int32, 'name': np.int32, 'score': np.float32,
+        'strand': np.int32, 'key': np.int64}
+    run_files = {column: os.path.join(temp_path, '{}.run'.format(column)) for column in dtypes}
+    categories = {'chrom': [], 'name': [], 'strand': []}
+    run_sizes = []
+    with ExitStack() as stack:
+        files = {column: stack.enter_context(open(run_file, 'wb')) for column, run_file in run_files.items()}
+        for chunk in read_bed6_chunks(bed_file, memory_budget):
+            for column in ['chrom', 'start', 'end', 'name', 'score', 'strand']:
+                values = chunk[column].values
+                if column in categories:
+                    values = encode_categories(values, categories[column])
+                values.astype(dtypes[column]).tofile(files[column])
+            run_sizes.append(len(chunk))
+    size = sum(run_sizes)
+    run_offsets = np.cumsum([0] + run_sizes)
+    runs = {
+        column: np.memmap(run_file, dtype=dtypes[column], mode='w+' if column == 'key' else 'r+', shape=(size,))
+        if size else np.zeros(0, dtype=dtypes[column])
+        for column, run_file in run_files.items()}
+    code_maps = {}
+    for column in categories:
+        code_maps[column], categories[column] = sort_categories(categories[column])
+    all_sorted = True
+    for i, (start, end) in enumerate(zip(run_offsets[:-1], run_offsets[1:])):
+        run = {column: np.array(values[start:end]) for column, values in runs.items() if column != 'key'}
+        for column, code_map in code_maps.items():
+            run[column] = code_map[run[column]]
+        run['key'] = get_sort_keys(run['chrom'], run['start'], run['strand'])
+        if not is_sorted(run['key']):
+            all_sorted = False
+            order = np.argsort(run['key'], kind='mergesort')
+            run = {column: values[order] for column, values in run.items()}
+        elif i and start < end and runs['key'][start - 1] > run['key'][0]:
+            all_sorted = False
+        for column, values in run.items():
+            runs[column][start:end] = values
+    if all_sorted:
+        blocks = (np.arange(start, end) for start, end in zip(run_offsets[:-1], run_offsets[1:]))
     else:
-        temp_file_interval = '{}{}.TEMPORARY'.format(TEMP_PATH, interval_file.split('/')[-1])
-        sorted_file = sort('-k1,1', '-k2,2n', '-k3,3n', interval_file)
-        with open(temp_file_interval, 'w') as file:
-            file.write(sorted_file)
-    df_interval = parse_bed6_to_df(temp_file_interval)
-    df_interval = remove_chr(df_interval, chrsizes_file)
-    df_interval_p = df_interval[df_interval['strand'] == '+'].copy()
-    df_interval_m = df_interval[df_interval['strand'] == '-'].copy()
-    interval_p = pbt.BedTool.from_dataframe(df_interval_p)
-    interval_m = pbt.BedTool.from_dataframe(df_interval_m)
-    temp_file = chrsizes_file + '.TEMPORARY'
-    temporary_file = sort('-k1,1', '-k2,2', chrsizes_file)
-    with open(temp_file, 'w') as file:
-        file.write(temporary_file)
-    complement_interval_p = interval_p.complement(g=temp_file)
-    complement_interval_m = interval_m.complement(g=temp_file)
-    df_interval_complement_p = complement_interval_p.to_dataframe(
-        names=['chrom', 'start', 'end'], dtype={'chrom': str, 'start': int, 'end': int})
-    df_interval_complement_m = complement_interval_m.to_dataframe(
-        names=['chrom', 'start', 'end'], dtype={'chrom': str, 'start': int, 'end': int})
-    df_interval_complement_p['name'] = '.'
-    df_interval_complement_p['score'] = '.'
-    df_interval_complement_p['strand'] = '+'
-    df_interval_complement_m['name'] = '.'
-    df_interval_complement_m['score'] = '.'
-    df_interval_complement_m['strand'] = '-'
-    df_interval_complement = pd.concat([df_interval_complement_p, df_interval_complement_m])
-    df_interval_complement = df_interval_complement.sort_values(
-        by=['chrom', 'start', 'strand'], ascending=[True, True, True]
-    ).reset_index(drop=True)
-    interval_complement = pbt.BedTool.from_dataframe(df_interval_complement)
-    if interval_complement:
-        return interval_complement
-
-
-def cut_per_chrom(chrom, df_p, df_m, df_peaks_p, df_peaks_m):
-    """Split data by strand then apply pandas cut to each strand.
-
-    Pandas cut uses IntervalIndex (done from the peaks file) to
-    assign each site its peak. Finally merges strands.
-    """
-    df_temp_p = df_peaks_p[df_peaks_p['chrom'] == chrom].copy()
-    df_temp_m = df_peaks_m[df_peaks_m['chrom'] == chrom].copy()
-    df_xl_p = df_p[df_p['chrom'] == chrom].copy()
-    df_xl_m = df_m[df_m['chrom'] == chrom].copy()
-    left_p = np.array(df_temp_p['start'])
-    right_p = np.array(df_temp_p['end'])
-    left_m = np.array(df_temp_m['start'])
-    right_m = np.array(df_temp_m['end'])
-    interval_index_p = pd.IntervalIndex.from_arrays(left_p, right_p, closed='left')
-    interval_index_m = pd.IntervalIndex.from_arrays(left_m, right_m, closed='left')
-    df_xl_p['cut'] = pd.cut(df_xl_p['start'], interval_index_p)
-    df_xl_m['cut'] = pd.cut(df_xl_m['start'], interval_index_m)
-    return pd.concat([df_xl_p, df_xl_m], ignore_index=True)
-
-
-def cut_sites_with_region(df_sites, df_region):
-    """Find peak interval the crosslinks belong to."""
-    df_p = df_sites[df_sites['strand'] == '+'].copy()
-    df_m = df_sites[df_sites['strand'] == '-'].copy()
-    df_region_p = df_region[df_region['strand'] == '+'].copy()
-    df_region_m = df_region[df_region['strand'] == '-'].copy()
-    df_cut = pd.DataFrame(columns=['chrom', 'start', 'end', 'name', 'score', 'strand', 'feature', 'attributes', 'cut'])
-    for chrom in set(df_region['chrom'].values):
-        df_temp = cut_per_chrom(chrom, df_p, df_m, df_region_p, df_region_m)
-        df_temp = df_temp[df_cut.columns]
-        df_cut = pd.concat([df_cut, df_temp], ignore_index=True)
-    return df_cut.dropna(axis=0)
+        keys = [runs['key'][start:end] for start, end in zip(run_offsets[:-1], run_offsets[1:])]
+        blocks = (
+            run_offsets[run_ids] + indices
+            for run_ids, indices in merge_runs(keys, max(memory_budget // SITE_BYTES // len(keys), 2 ** 10)))
+    outputs = {}
+    for column, name in [
+            ('start', 'start'), ('end', 'end'), ('score', 'score'), ('name', 'name_codes'),
+            ('strand', 'strand_codes')]:
+        outputs[column] = np.lib.format.open_memmap(
+            os.path.join(temp_path, '{}.npy'.format(name)), mode='w+', dtype=dtypes[column], shape=(size,))
+    chrom_counts = np.zeros(len(categories['chrom']), dtype=np.int64)
+    position = 0
+    for indices in blocks:
+        for column, output in outputs.items():
+            output[position:position + len(indices)] = runs[column][indices]
+        chrom_codes = runs['chrom'][indices]
+        chrom_counts += np.bincount(chrom_codes[chrom_codes >= 0], minlength=len(chrom_counts))
+        position += len(indices)
+    for output in outputs.values():
+        output.flush()
+    del runs, outputs
+    for run_file in run_files.values():
+        os.remove(run_file)
+    np.save(os.path.join(temp_path, 'chrom_offsets.npy'), np.concatenate([[0], np.cumsum(chrom_counts)]))
+    for column in categories:
+        np.save(os.path.join(temp_path, '{}s.npy'.format(column)), np.array(categories[column], dtype=str))
+    finish_store(temp_path, path, meta)
+
+
+def get_bed_store(bed_file, cache_dir=CACHE_DIR, memory_budget=MEMORY_BUDGET):
+    """Return memory-mapped columnar store of BED6 file, converting it on first use.
+
+    Store is placed next to the BED file (see ``get_store_path``) and is
+    reused while size and modification time of the file are unchanged. If
+    they changed, but content of the file did not (e.g. file was touched
+    or copied), store is still reused.
+    """
+    path = get_store_path(bed_file, '.columns', cache_dir)
+    stamp = get_file_stamp(bed_file)
+    stored_meta = get_store_meta(path) or {}
+    sha1 = stored_meta.get('sha1')
+    if sha1 is not None and any(stored_meta.get(key) != value for key, value in stamp.items()):
+        if get_file_hash(bed_file) == sha1:
+            update_store_meta(path, dict(stamp, sha1=sha1))
+    store = load_store(path, dict(stamp, sha1=sha1))
+    if store is None:
+        print(f'Converting {bed_file} to columnar store {path}')
+        meta = dict(stamp, sha1=get_file_hash(bed_file))
+        convert_bed(bed_file, path, meta, memory_budget)
+        store = load_store(path, meta)
+    return store
+
+
+def get_bed_chunks(bed_store, memory_budget=MEMORY_BUDGET):
+    """Yield chunks of intervals in columnar BED store as DataFrames.
+
+    Columns are the same as those of ``read_bed6_chunks``, but intervals
+    are sorted by chromosome, start and strand.
+    """
+    size = len(bed_store['start'])
+    chunk_size = max(memory_budget // SITE_BYTES, 1)
+    for i in range(0, max(size, 1), chunk_size):
+        index = np.arange(i, min(i + chunk_size, size))
+        chrom_codes = np.searchsorted(bed_store['chrom_offsets'], index, side='right') - 1
+        yield pd.DataFrame({
+            'chrom': pd.Categorical.from_codes(chrom_codes, categories=bed_store['chroms'].tolist()),
+            'start': bed_store['start'][index],
+            'end': bed_store['end'][index],
+            'name': pd.Categorical.from_codes(bed_store['name_codes'][index], categories=bed_store['names'].tolist()),
+            'score': bed_store['score'][index],
+            'strand': pd.Categorical.from_codes(
+                bed_store['strand_codes'][index], categories=bed_store['strands'].tolist()),
+        })
+
+
+def get_interval_keys(chrom_codes, strand_codes, positions):
+    """Combine chromosome, strand and position into sortable integer keys.
+
+    Positions with negative chromosome or strand code get key -1.
+    """
+    keys = (np.asarray(chrom_codes, dtype=np.int64) * len(STRANDS) + strand_codes) * 2 ** 32 + positions
+    keys[(np.asarray(chrom_codes) < 0) | (np.asarray(strand_codes) < 0)] = -1
+    return keys
+
+
+def find_intervals(keys, start_keys, end_keys):
+    """Find interval containing each position.
+
+    Intervals are half-open [start, end), sorted by start and should not
+    overlap. All positions are assigned with a single binary search on
+    keys combining chromosome, strand and position. Return array of
+    indices of intervals, -1 for positions outside of intervals.
+    """
+    intervals = np.full(len(keys), -1, dtype=np.int64)
+    index = np.searchsorted(start_keys, keys, side='right') - 1
+    inside = (index >= 0) & (keys >= 0)
+    inside[inside] = keys[inside] < end_keys[index[inside]]
+    intervals[inside] = index[inside]
+    return intervals
+
+
+def get_group_quantiles(groups, values, percentile):
+    """Get quantile of values in the group of each element.
+
+    Groups are given as integer codes, negative codes denote elements
+    without a group. All groups are sorted at once and quantile of each
+    group is obtained from group offsets in sorted values, using linear
+    interpolation in the same way as ``pandas.core.groupby.GroupBy.quantile``.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    quantiles = np.full(len(values), np.nan)
+    in_group = (groups >= 0) & ~np.isnan(values)
+    if not in_group.any():
+        return quantiles
+    groups_in, values_in = groups[in_group], values[in_group]
+    sorted_values = values_in[np.lexsort((values_in, groups_in))]
+    sizes = np.bincount(groups_in)
+    starts = np.cumsum(sizes) - sizes
+    # codes of groups without elements get position of the last value
+    last = np.minimum(starts + np.maximum(sizes - 1, 0), len(sorted_values) - 1)
+    idx_val = percentile * np.maximum(sizes - 1, 0)
+    idx = np.floor(idx_val).astype(np.int64)
+    frac = idx_val - idx
+    lower = sorted_values[np.minimum(starts + idx, last)]
+    upper = sorted_values[np.minimum(starts + idx + 1, last)]
+    group_quantiles = np.where(frac == 0, lower, lower + (upper - lower) * frac)
+    quantiles[in_group] = group_quantiles[groups_in]
+    return quantiles
+
+
+def filter_group_percentile(df_in, group_column, percentile):
+    """Keep crosslinks with score higher than percentile of their group."""
+    groups, _ = pd.factorize(df_in[group_column])
+    return df_in[df_in['score'].values > get_group_quantiles(groups, df_in['score'].values, percentile)]
 
 
 def percentile_filter_xlinks(df_in, percentile=0.7):
     """Calculate threshold and filter sites by it."""
-    df_in['cut'] = df_in['cut'].astype(str)
-    df_in['quantile'] = df_in['cut'].map(df_in.groupby('cut').quantile(q=percentile)['score'])
-    df_in = df_in[df_in['score'] > df_in['quantile']]
+    df_in = filter_group_percentile(df_in, 'cut', percentile)
     return df_in[['chrom', 'start', 'end', 'name', 'score', 'strand', 'feature', 'attributes']]
 
 
-def intersect_merge_info(region, s_file):
-    """Intersect while keeping information from region file."""
-    interval_file = REGIONS_MAP[region]
-    try:
-        df_1 = intersect(interval_file, s_file).to_dataframe(
-            names=['chrom', 'start', 'end', 'name', 'score', 'strand'],
-            dtype={'chrom': str, 'start': int, 'end': int, 'name': str, 'score': float, 'strand': str})
-        df_1 = df_1.groupby(['chrom', 'start', 'end', 'strand'], as_index=False)['score'].sum(axis=0)
-        df_1['name'] = '.'
-        df_2 = intersect(s_file, interval_file).to_dataframe(
-            names=['seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame', 'attributes'],
-            dtype={'seqname': str, 'source': str, 'feature': str, 'start': int, 'end': int, 'score': str,
-                   'strand': str, 'frame': str, 'attributes': str})
-        df_2.drop_duplicates(subset=['seqname', 'start', 'end', 'strand'], keep='first')
-    except AttributeError:
-        return
-    df_2 = df_2.drop(columns=['source', 'score', 'frame', 'start']).rename(index=str, columns={"seqname": "chrom"})
-    return pd.merge(df_1, df_2, on=['chrom', 'strand', 'end'])
+def get_gene_names(attributes):
+    """Get gene names from GTF attributes."""
+    return pd.Series(attributes).str.split(';').str[1].str.split(' ').str[1].str.strip('"').values
+
+
+def get_name_codes(values, names):
+    """Return indices of values in list of names, -1 for values not in it."""
+    values = pd.Categorical(values)
+    codes = np.append(pd.Index(names).get_indexer(values.categories), -1)
+    return codes[values.codes]
 
 
-def get_threshold_sites(s_file, percentile=0.7):
+def annotate_sites(df_sites, annotation):
+    """Annotate crosslinks with regions used for thresholding.
+
+    All crosslinks are assigned in one call to intervals of each of the
+    ``REGIONS_QUANTILE`` families in compiled ``annotation`` (see
+    ``compile_annotation``). Scores of repeated crosslinks are summed.
+    Return DataFrame of crosslinks with columns feature, attributes, name
+    (gene name for CDS, UTR and ncRNA, otherwise '.'), cut (index of
+    interval in its family) and family. Chromosome and strand are
+    categorical with categories in sorted order.
+    """
+    keys = get_interval_keys(
+        get_name_codes(df_sites['chrom'], annotation['chroms']),
+        get_name_codes(df_sites['strand'], STRANDS),
+        df_sites['start'].values)
+    df_keys = pd.DataFrame({'key': keys, 'end': df_sites['end'].values, 'score': df_sites['score'].values})
+    df_keys = df_keys[keys >= 0].astype({'score': np.float64})
+    df_keys = df_keys.groupby(['key', 'end'], as_index=False, sort=False)['score'].sum()
+    keys = df_keys['key'].values
+    chroms = sorted(annotation['chroms'])
+    chrom_codes = pd.Index(chroms).get_indexer(annotation['chroms'])[keys // 2 ** 32 // len(STRANDS)]
+    df_sites = pd.DataFrame({
+        'chrom': pd.Categorical.from_codes(chrom_codes, categories=chroms),
+        'start': keys % 2 ** 32,
+        'end': df_keys['end'].values,
+        'strand': pd.Categorical.from_codes(keys // 2 ** 32 % len(STRANDS), categories=STRANDS),
+        'score': df_keys['score'].values,
+    })
+    annotated = []
+    for family in REGIONS_QUANTILE:
+        interval = find_intervals(keys, annotation[family + '_starts'], annotation[family + '_ends'])
+        inside = interval >= 0
+        df_family = df_sites.loc[inside].reset_index(drop=True)
+        interval = interval[inside]
+        if family == 'cds_utr_ncrna':
+            df_family['name'] = pd.Categorical.from_codes(
+                annotation[family + '_genes'][interval], categories=annotation['genes'])
+        else:
+            df_family['name'] = '.'
+        df_family['feature'] = pd.Categorical.from_codes(
+            annotation[family + '_features'][interval], categories=annotation['features'])
+        df_family['attributes'] = pd.Categorical.from_codes(
+            annotation[family + '_attributes'][interval], categories=annotation['attributes'])
+        df_family['cut'] = interval
+        df_family['family'] = pd.Categorical.from_codes(
+            np.full(len(df_family), REGIONS_QUANTILE.index(family)), categories=REGIONS_QUANTILE)
+        annotated.append(df_family)
+    return pd.concat(annotated, ignore_index=True, sort=False)
+
+
+def annotate_bed6(sites_file, annotation, memory_budget=MEMORY_BUDGET, cache_dir=CACHE_DIR):
+    """Annotate crosslinks from BED6 file with regions used for thresholding.
+
+    Crosslinks are read from columnar store of the file (see
+    ``get_bed_store``) and annotated in chunks, so only annotated crosslinks
+    in compact form are kept in memory. The result is the same as with
+    ``annotate_sites`` on the whole file.
+    """
+    chunks = get_bed_chunks(get_bed_store(sites_file, cache_dir, memory_budget), memory_budget)
+    annotated = [annotate_sites(chunk, annotation) for chunk in chunks]
+    df_annotated = pd.concat(annotated, ignore_index=True, sort=False)
+    if len(annotated) > 1:
+        # scores of crosslinks repeated in different chunks are summed and
+        # crosslinks are ordered by family as in a single chunk
+        columns = ['family', 'chrom', 'start', 'end', 'strand']
+        scores = df_annotated.groupby(columns, sort=False, observed=True)['score'].transform('sum')
+        df_annotated = df_annotated.assign(score=scores)[~df_annotated.duplicated(columns)]
+        order = np.argsort(df_annotated['family'].cat.codes.values, kind='mergesort')
+        df_annotated = df_annotated.iloc[order].reset_index(drop=True)
+    return df_annotated
+
+
+def get_threshold_sites(df_annotated, percentile=0.7):
     """Apply crosslink filtering based on dynamical thresholds.
 
     Regions for thresholds are defined as follows: introns and
@@ -331,55 +859,95 @@ def get_threshold_sites(s_file, percentile=0.7):
     percentile are applied and finally threshold crosslinks sites are
     sorted.
     """
-    df_out = pd.DataFrame(columns=['chrom', 'start', 'end', 'name', 'score', 'strand', 'feature', 'attributes'])
+    df_out = []
     for region in REGIONS_QUANTILE:
-        print(f'Thresholding {region}')
-        region_threshold_cp = time.time()
-        df_reg = intersect_merge_info(region, s_file)
-        if df_reg is None:
+        df_reg = df_annotated[df_annotated['family'] == region]
+        if df_reg.empty:
             return
         print(f'lenght of df_reg for {region} is: {len(df_reg)}')
         if region == 'cds_utr_ncrna':
-            df_reg.name = df_reg.attributes.map(lambda x: x.split(';')[1].split(' ')[1].strip('"'))
-            df_reg['quantile'] = df_reg['name'].map(df_reg.groupby(['name']).quantile(q=percentile)['score'])
-            df_filtered = df_reg[df_reg['score'] > df_reg['quantile']].drop(columns=['quantile'])
-            df_out = pd.concat([df_out, df_filtered], ignore_index=True, sort=False)
+            df_out.append(filter_group_percentile(df_reg, 'name', percentile))
         if region in ['intron', 'intergenic']:
-            df_region = parse_region_to_df(REGIONS_MAP[region])
-            df_cut = cut_sites_with_region(df_reg, df_region)
-            df_filtered = percentile_filter_xlinks(df_cut)
-            df_out = pd.concat([df_out, df_filtered], ignore_index=True, sort=False)
-        print(f'Thresholding {region} runtime: {((time.time() - region_threshold_cp) / 60):.2f} min')
+            df_out.append(percentile_filter_xlinks(df_reg))
+    df_out = pd.concat(df_out, ignore_index=True, sort=False)
+    df_out = df_out[['chrom', 'start', 'end', 'name', 'score', 'strand', 'feature', 'attributes']]
     return df_out.sort_values(by=['chrom', 'start', 'strand'], ascending=[True, True, True]).reset_index(drop=True)
 
 
-def get_all_sites(s_file):
+def get_all_sites(df_annotated):
     """Get crosslink data into appropriate dataframe without thresholding."""
-    df_out = pd.DataFrame(columns=['chrom', 'start', 'end', 'name', 'score', 'strand', 'feature', 'attributes'])
-    for region in REGIONS_QUANTILE:
-        df_reg = intersect_merge_info(region, s_file)
-        if df_reg.empty:
-            continue
-        if region == 'cds_utr_ncrna':
-            df_reg.name = df_reg.attributes.map(lambda x: x.split(';')[1].split(' ')[1].strip('"'))
-            df_reg['quantile'] = None
-            df_out = pd.concat([df_out, df_reg], ignore_index=True, sort=False)
-        if region in ['intron', 'intergenic']:
-            df_region = parse_region_to_df(REGIONS_MAP[region])
-            df_cut = cut_sites_with_region(df_reg, df_region)
-            df_filtered = df_cut[['chrom', 'start', 'end', 'name', 'score', 'strand', 'feature', 'attributes']]
-            df_out = pd.concat([df_out, df_filtered], ignore_index=True, sort=False)
+    df_out = df_annotated[['chrom', 'start', 'end', 'name', 'score', 'strand', 'feature', 'attributes']]
     return df_out.sort_values(by=['chrom', 'start', 'strand'], ascending=[True, True, True]).reset_index(drop=True)
 
 
-def get_sequences(sites, fasta, fai, window_l, window_r, merge_overlaps=False):
-    """Get genome sequences around positions defined in sites."""
-    sites = pbt.BedTool(sites).sort()
-    sites_extended = sites.slop(l=window_l, r=window_r, g=fai)  # noqa
-    if merge_overlaps:
-        sites_extended = sites_extended.merge(s=True)
-    seq_tab = sites_extended.sequence(s=True, fi=fasta, tab=True)
-    return [line.split("\t")[1].strip() for line in open(seq_tab.seqfn)]
+def convert_genome(fasta, fai, path, meta, chunk_size=2 ** 22):
+    """Convert genome FASTA to a store of base codes.
+
+    Sequences of all chromosomes are stored one after another in a single
+    array of codes as defined by ``BASE_CODES``. Chromosome names, sizes
+    and offsets in the array are stored alongside. FASTA index is used to
+    read bases directly from memory-mapped FASTA in chunks of
+    ``chunk_size`` bases.
+    """
+    df_fai = pd.read_csv(
+        fai, sep='\t', header=None, usecols=[0, 1, 2, 3, 4],
+        names=['chrom', 'size', 'offset', 'linebases', 'linewidth'], dtype={'chrom': str})
+    sizes = df_fai['size'].values.astype(np.int64)
+    offsets = np.cumsum(sizes) - sizes
+    temp_path = create_store(path)
+    raw = np.memmap(fasta, dtype=np.uint8, mode='r')
+    sequence = np.lib.format.open_memmap(
+        os.path.join(temp_path, 'sequence.npy'), mode='w+', dtype=np.uint8, shape=(int(sizes.sum()),))
+    for row, offset in zip(df_fai.itertuples(), offsets):
+        for start in range(0, row.size, chunk_size):
+            bases = np.arange(start, min(start + chunk_size, row.size), dtype=np.int64)
+            file_positions = row.offset + bases // row.linebases * row.linewidth + bases % row.linebases
+            sequence[offset + start:offset + start + len(bases)] = BASE_CODES[raw[file_positions]]
+    sequence.flush()
+    del sequence
+    np.save(os.path.join(temp_path, 'chroms.npy'), np.array(df_fai['chrom'].tolist(), dtype=str))
+    np.save(os.path.join(temp_path, 'sizes.npy'), sizes)
+    np.save(os.path.join(temp_path, 'offsets.npy'), offsets)
+    finish_store(temp_path, path, meta)
+
+
+def get_genome_store(fasta, fai, cache_dir=CACHE_DIR):
+    """Return memory-mapped genome store, converting FASTA on first use.
+
+    Store is reused as long as the FASTA file does not change.
+    """
+    path = get_store_path(fasta, '.codes', cache_dir)
+    meta = get_file_stamp(fasta)
+    store = load_store(path, meta)
+    if store is None:
+        print(f'Converting {fasta} to genome store {path}')
+        convert_genome(fasta, fai, path, meta)
+        store = load_store(path, meta)
+    return store
+
+
+def get_windows(genome_store, chroms, positions, strands, window_l, window_r):
+    """Get base codes in windows around positions from genome store.
+
+    Each window covers window_l bases before and window_r bases after the
+    position on the genome and is reverse complemented for positions on
+    the minus strand. Parts of windows outside of chromosomes are filled
+    with ``PADDING``. Return 2D array with a row for each position.
+    """
+    chrom_index = pd.Index(genome_store['chroms']).get_indexer(np.asarray(chroms))
+    sizes = np.where(chrom_index >= 0, genome_store['sizes'][chrom_index], 0)
+    offsets = genome_store['offsets'][chrom_index]
+    positions = np.asarray(positions, dtype=np.int64)
+    width = window_l + window_r + 1
+    windows = np.full((len(positions), width), PADDING, dtype=np.uint8)
+    for i in range(0, len(positions), CHUNK_SIZE):
+        chunk = slice(i, i + CHUNK_SIZE)
+        coords = positions[chunk, None] - window_l + np.arange(width)
+        inside = (coords >= 0) & (coords < sizes[chunk, None])
+        windows[chunk][inside] = genome_store['sequence'][(offsets[chunk, None] + coords)[inside]]
+    minus = np.asarray(strands) == '-'
+    windows[minus] = COMPLEMENT_CODES[windows[minus, ::-1]]
+    return windows
 
 
 def count_kmers(sequences, k_length):
@@ -397,29 +965,338 @@ def count_kmers(sequences, k_length):
     return kmers
 
 
+def get_possible_kmers(k_length):
+    """Return list of all kmers of given length, ordered by their codes."""
+    return [''.join(i) for i in product('ACGT', repeat=k_length)]
+
+
+def get_positions(k_length, window):
+    """Return positions of kmers relative to crosslinks."""
+    shift = int((k_length + 1) / 2)
+    return list(range(-window + shift, window + shift + 1))
+
+
+def encode_sequences(seqs):
+    """Encode a list of sequences into 2D array of 2-bit base codes.
+
+    Sequences shorter than the longest one are right-padded with
+    ``PADDING``.
+    """
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    width = int(lengths.max()) if len(seqs) else 0
+    joined = np.frombuffer(''.join(seqs).encode('ascii', 'replace'), dtype=np.uint8)
+    if np.all(lengths == width):
+        return BASE_CODES[joined].reshape(len(seqs), width)
+    encoded = np.full((len(seqs), width), PADDING, dtype=np.uint8)
+    encoded[np.arange(width) < lengths[:, None]] = BASE_CODES[joined]
+    return encoded
+
+
+def get_kmer_codes(encoded, k_length, window):
+    """Return code of kmer on each position of each encoded sequence.
+
+    Columns correspond to positions returned by ``get_positions``. Positions
+    without a valid kmer get code -1. The same positions as in original
+    string-based counting are considered: kmers starting from ``k_length``
+    base on to the ``k_length`` bases before the end of each sequence.
+    """
+    n_pos = 2 * window + 1
+    codes = np.full((encoded.shape[0], n_pos), -1, dtype=np.int64)
+    first = k_length
+    last = min(encoded.shape[1] - k_length, first + n_pos)
+    if last <= first:
+        return codes
+    code = np.zeros((encoded.shape[0], last - first), dtype=np.int64)
+    valid = encoded[:, first + k_length:last + k_length] != PADDING
+    for j in range(k_length):
+        bases = encoded[:, first + j:last + j]
+        code = code * 4 + bases
+        valid &= bases < 4
+    codes[:, :last - first] = np.where(valid, code, -1)
+    return codes
+
+
+def get_kmer_codes_lengths(encoded, k_lengths, window):
+    """Return dictionary of kmer codes on each position for several kmer lengths.
+
+    Encoded sequences are windows for the longest kmer length, i.e. of
+    width ``2 * (window + max(k_lengths)) + 1``. Kmers of all lengths on a
+    position start at the same base, so codes of each length are obtained
+    from codes of kmers one base shorter in a single pass. Codes are the
+    same as those of ``get_kmer_codes`` on windows for each length.
+    """
+    k_max = max(k_lengths)
+    n_pos = 2 * window + 1
+    assert encoded.shape[1] == 2 * (window + k_max) + 1
+    code = np.zeros((encoded.shape[0], n_pos), dtype=np.int64)
+    valid = np.ones((encoded.shape[0], n_pos), dtype=bool)
+    codes = {}
+    for k_length in range(1, k_max + 1):
+        bases = encoded[:, k_max + k_length - 1:k_max + k_length - 1 + n_pos]
+        code = code * 4 + bases
+        valid &= bases < 4
+        if k_length in k_lengths:
+            not_padded = encoded[:, k_max + k_length:k_max + k_length + n_pos] != PADDING
+            codes[k_length] = np.where(valid & not_padded, code, -1)
+    return codes
+
+
+def pos_count_encoded_lengths(encoded, k_lengths, window, sparse=False):
+    """Return dictionary of positional kmer counts for several kmer lengths.
+
+    Same as ``pos_count_matrix``, but for 2D array of encoded windows of
+    the longest kmer length (see ``get_kmer_codes_lengths``). If sparse,
+    counts are given only for kmers present on each position (see
+    ``count_codes_sparse``).
+    """
+    if sparse:
+        empty = np.empty((0, 2 * window + 1), dtype=np.int64)
+        counts = {k_length: [(1, count_codes_sparse(empty))] for k_length in k_lengths}
+    else:
+        counts = {k_length: np.zeros((4 ** k_length, 2 * window + 1), dtype=np.int64) for k_length in k_lengths}
+    for i in range(0, encoded.shape[0], CHUNK_SIZE):
+        for k_length, codes in get_kmer_codes_lengths(encoded[i:i + CHUNK_SIZE], k_lengths, window).items():
+            if sparse:
+                push_sparse_counts(counts[k_length], count_codes_sparse(codes))
+            else:
+                counts[k_length] += count_codes(codes, k_length)
+    if sparse:
+        return {k_length: sum_sparse_counts([part for _, part in stack]) for k_length, stack in counts.items()}
+    return counts
+
+
+def count_codes_sparse(codes):
+    """Get positional counts of kmers present in 2D array of kmer codes.
+
+    Counts are given as a pair of sorted keys (kmer code times number of
+    positions plus position index) and counts of kmers on positions, so
+    memory does not grow with the number of all possible kmers.
+    """
+    n_pos = codes.shape[1]
+    keys = codes.astype(np.int64) * n_pos + np.arange(n_pos)
+    return np.unique(keys[codes >= 0], return_counts=True)
+
+
+def sum_sparse_counts(sparse_counts):
+    """Sum list of sparse positional counts (see ``count_codes_sparse``)."""
+    keys, inverse = np.unique(np.concatenate([keys for keys, _ in sparse_counts]), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=np.concatenate([counts for _, counts in sparse_counts]))
+    return keys, counts.astype(np.int64)
+
+
+def push_sparse_counts(stack, sparse_counts):
+    """Add sparse counts of a chunk to a stack of partial sums.
+
+    Partial sums of the same number of chunks are merged, so the stack stays
+    short and counts of each chunk are merged only a logarithmic number of
+    times (instead of merging running total with every chunk).
+    """
+    stack.append((1, sparse_counts))
+    while len(stack) > 1 and stack[-1][0] == stack[-2][0]:
+        (n_chunks, last), (_, previous) = stack.pop(), stack.pop()
+        stack.append((2 * n_chunks, sum_sparse_counts([previous, last])))
+
+
+def get_sparse_kmers(sparse_counts, n_pos):
+    """Return sorted codes of kmers present in sparse positional counts."""
+    return np.unique(sparse_counts[0] // n_pos)
+
+
+def get_sparse_rows(sparse_counts, kmer_codes, n_pos):
+    """Return 2D array of positional counts of kmers with given sorted codes."""
+    keys, counts = sparse_counts
+    rows = get_kmer_rows(keys // n_pos, kmer_codes)
+    dense = np.zeros((len(kmer_codes), n_pos), dtype=np.int64)
+    dense[rows[rows >= 0], keys[rows >= 0] % n_pos] = counts[rows >= 0]
+    return dense
+
+
+def get_kmer_rows(codes, kmer_codes):
+    """Return indices of kmer codes in sorted ``kmer_codes``, -1 for codes not in it."""
+    codes = np.asarray(codes)
+    if len(kmer_codes) == 0:
+        return np.full(codes.shape, -1, dtype=np.int64)
+    rows = np.minimum(np.searchsorted(kmer_codes, codes), len(kmer_codes) - 1)
+    return np.where((codes >= 0) & (kmer_codes[rows] == codes), rows, -1)
+
+
+def decode_kmers(kmer_codes, k_length):
+    """Return kmers (with U instead of T) of given kmer codes."""
+    digits = (np.asarray(kmer_codes, dtype=np.int64)[:, None] // 4 ** np.arange(k_length - 1, -1, -1)) % 4
+    letters = np.array([b'A', b'C', b'G', b'U'])[digits]
+    return np.ascontiguousarray(letters).view(f'S{k_length}').ravel().astype(str).tolist()
+
+
+def count_codes(codes, k_length):
+    """Get 2D array of kmer counts on each position from kmer codes."""
+    n_pos = codes.shape[1]
+    n_bins = 4 ** k_length * n_pos
+    bins = codes.astype(np.int64) * n_pos + np.arange(n_pos)
+    return np.bincount(bins[codes >= 0], minlength=n_bins).reshape(4 ** k_length, n_pos)
+
+
+def pos_count_matrix(seqs, k_length, window):
+    """Get 2D array of kmer counts on each position around crosslinks.
+
+    Rows correspond to kmers as returned by ``get_possible_kmers`` and
+    columns to positions as returned by ``get_positions``. Sequences are
+    processed in chunks of ``CHUNK_SIZE`` to limit memory usage.
+    """
+    counts = np.zeros((4 ** k_length, 2 * window + 1), dtype=np.int64)
+    for i in range(0, len(seqs), CHUNK_SIZE):
+        counts += count_codes(get_kmer_codes(encode_sequences(seqs[i:i + CHUNK_SIZE]), k_length, window), k_length)
+    return counts
+
+
+def get_pos_count_dict(counts, k_length, window):
+    """Convert 2D array of positional counts to dictionary of dictionaries."""
+    positions = get_positions(k_length, window)
+    return {kmer: dict(zip(positions, row)) for kmer, row in zip(get_possible_kmers(k_length), counts.tolist())}
+
+
+def get_relevant_codes(codes, prtxn_mask):
+    """Return kmer codes with codes on non relevant positions set to -1.
+
+    Relevant positions of each kmer are defined by rows of 2D boolean
+    ``prtxn_mask``.
+    """
+    positions = np.broadcast_to(np.arange(codes.shape[1]), codes.shape)
+    return np.where((codes >= 0) & prtxn_mask[np.maximum(codes, 0), positions], codes, -1)
+
+
+def get_relevant_window_codes(windows, k_length, window, prtxn_mask, kmer_codes=None):
+    """Return relevant kmer codes on each position of encoded windows.
+
+    Windows can be wider than needed for ``k_length`` (e.g. windows for the
+    longest of several kmer lengths), codes are computed on a view of their
+    middle part (see ``get_kmer_codes_lengths``). If ``kmer_codes`` are
+    given, codes are replaced by indices of kmers in them (see
+    ``get_kmer_rows``). Codes on positions that are not relevant are set to
+    -1 (see ``get_relevant_codes``).
+    """
+    trim = (windows.shape[1] - 2 * (window + k_length) - 1) // 2
+    codes = get_kmer_codes_lengths(windows[:, trim:windows.shape[1] - trim], [k_length], window)[k_length]
+    if kmer_codes is not None:
+        codes = get_kmer_rows(codes, kmer_codes)
+    return get_relevant_codes(codes, prtxn_mask)
+
+
+def get_random_samples(n_population, n_sample, n_samples=100, seed=None):
+    """Yield arrays of indices of random samples drawn without replacement.
+
+    If seed is not given, global random state is used so samples are the
+    same as the ones obtained by sampling sequences with ``random.sample``.
+    """
+    rand = random if seed is None else random.Random(seed)
+    for _ in range(n_samples):
+        yield np.array(rand.sample(range(n_population), n_sample), dtype=np.int64)
+
+
+def get_random_aroxn(ref_windows, relevant_codes, n_sample, norm, n_samples=100, seed=None):
+    """Get average relative occurences for random samples of reference.
+
+    Samples are drawn as indices of rows in 2D array of encoded reference
+    windows, so only windows of each sample are gathered and converted to
+    relevant kmer codes with function ``relevant_codes`` (see
+    ``get_relevant_window_codes``). Counts on relevant positions are divided
+    by ``norm``, average distal occurence times number of relevant positions
+    of each kmer. Return 2D array with a row for each sample.
+    """
+    random_aroxn = np.empty((n_samples, len(norm)))
+    for i, sample in enumerate(get_random_samples(len(ref_windows), n_sample, n_samples, seed)):
+        sampled = relevant_codes(ref_windows[sample])
+        random_aroxn[i] = np.bincount(sampled[sampled >= 0], minlength=len(norm)) / norm
+    return random_aroxn
+
+
+def get_analytic_aroxn(ref_windows, relevant_codes, n_sample, norm):
+    """Get exact mean and standard deviation of aroxn of random samples.
+
+    For each kmer, let y be the number of its occurences on relevant
+    positions of a reference sequence. Sum of y over a random sample of n
+    out of N reference sequences drawn without replacement has mean
+    n * mean(y) and variance n * var(y) * (N - n) / (N - 1). Both are
+    divided by ``norm`` as in ``get_random_aroxn``. Relevant kmer codes are
+    obtained from views of chunks of reference windows. Samples larger than
+    reference raise ValueError, as they do with random samples.
+    """
+    n_population, n_kmers = len(ref_windows), len(norm)
+    if n_sample > n_population:
+        raise ValueError(
+            f'Sample of {n_sample} thresholded crosslinks is larger than {n_population} reference crosslinks.')
+    sum_y = np.zeros(n_kmers)
+    sum_y2 = np.zeros(n_kmers)
+    for i in range(0, n_population, CHUNK_SIZE):
+        chunk = relevant_codes(ref_windows[i:i + CHUNK_SIZE])
+        rows = np.nonzero(chunk >= 0)[0]
+        keys, y_counts = np.unique(rows * n_kmers + chunk[chunk >= 0], return_counts=True)
+        sum_y += np.bincount(keys % n_kmers, weights=y_counts, minlength=n_kmers)
+        sum_y2 += np.bincount(keys % n_kmers, weights=y_counts ** 2, minlength=n_kmers)
+    mean_y = sum_y / n_population
+    var_y = np.maximum(sum_y2 / n_population - mean_y ** 2, 0)
+    fpc = (n_population - n_sample) / (n_population - 1) if n_population > 1 else 0
+    return n_sample * mean_y / norm, np.sqrt(n_sample * var_y * fpc) / norm
+
+
+def get_null_model(ref_windows, relevant_codes, n_sample, norm, null='bootstrap', seed=None):
+    """Return mean and standard deviation of aroxn of random samples of reference.
+
+    Reference is given as encoded windows and function returning their
+    relevant kmer codes (see ``get_random_aroxn``). For null models see
+    ``run``. For 'check', mean and standard deviation
+    obtained with random samples are returned together with analytic ones,
+    otherwise the latter are None.
+    """
+    analytic = None
+    if null in ['bootstrap', 'check']:
+        random_aroxn = get_random_aroxn(ref_windows, relevant_codes, n_sample, norm, seed=seed)
+        null_avg, null_std = np.mean(random_aroxn, axis=0), np.std(random_aroxn, axis=0)
+    if null in ['analytic', 'check']:
+        # mean and standard deviation of aroxn can also be calculated
+        # exactly without drawing random samples
+        analytic = get_analytic_aroxn(ref_windows, relevant_codes, n_sample, norm)
+    if null == 'analytic':
+        null_avg, null_std = analytic
+        analytic = None
+    return null_avg, null_std, analytic
+
+
+def get_null_check(kmers, artxn, random_avg, random_std, analytic_avg, analytic_std):
+    """Compare analytic null model with the one obtained by random sampling.
+
+    Return table of means, standard deviations and z-scores obtained with
+    both approaches and print largest differences between them.
+    """
+    artxn = pd.Series(artxn).reindex(kmers).values
+    df_check = pd.DataFrame({
+        'mean_bootstrap': random_avg,
+        'mean_analytic': analytic_avg,
+        'std_bootstrap': random_std,
+        'std_analytic': analytic_std,
+        'z-score_bootstrap': (artxn - random_avg) / random_std,
+        'z-score_analytic': (artxn - analytic_avg) / analytic_std,
+    }, index=kmers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_diff = np.abs(df_check['mean_analytic'] / df_check['mean_bootstrap'] - 1)
+        std_diff = np.abs(df_check['std_analytic'] / df_check['std_bootstrap'] - 1)
+    z_diff = np.abs(df_check['z-score_analytic'] - df_check['z-score_bootstrap'])
+    finite = np.isfinite
+    print(f'Analytic null model max relative difference: mean {mean_diff[finite(mean_diff)].max():.4f}, '
+          f'std {std_diff[finite(std_diff)].max():.4f}; max z-score difference {z_diff[finite(z_diff)].max():.4f}')
+    return df_check
+
+
 def pos_count_kmer(seqs, k_length, window, kmer_list=False):
     """Get number of occurences of each kmer for each position.
 
     Alternativly, if kmer_list is defined, it returns positional counts
     only for kmers in the list.
     """
-    shift = int((k_length + 1) / 2)
-    zero_counts = {pos: 0 for pos in range(-window + shift, window + shift + 1)}
+    positions = get_positions(k_length, window)
+    kmer_pos_count = get_pos_count_dict(pos_count_matrix(seqs, k_length, window), k_length, window)
     if kmer_list:
-        possible_kmers = kmer_list
-    else:
-        possible_kmers = []
-        for i in product('ACGT', repeat=k_length):
-            possible_kmers.append("".join(i))
-    kmer_pos_count = {x: zero_counts.copy() for x in possible_kmers}
-    for sequence in seqs:
-        for i in range(k_length, len(sequence) - k_length):
-            kmer = sequence[i: i + k_length]
-            relative_pos = i - window - k_length + shift
-            try:
-                kmer_pos_count[kmer][relative_pos] += 1
-            except KeyError:
-                pass
+        zero_counts = {pos: 0 for pos in positions}
+        return {kmer: kmer_pos_count.get(kmer, zero_counts).copy() for kmer in kmer_list}
     return kmer_pos_count
 
 
@@ -436,17 +1313,6 @@ def normalise_kmer_frequency(observed, reference):
     return normalised
 
 
-def get_max_pos(pos_count, window_peak_l=15, window_peak_r=15):
-    """Return position with max values for every kmer in the dictionary."""
-    max_pos = {}
-    pc_peak = {}
-    for motif, pos_c in pos_count.items():
-        pc_peak[motif] = {x: pos_c[x] for x in range(-abs(window_peak_l), window_peak_r + 1)}
-    for motif, pos in pc_peak.items():
-        max_pos[motif] = max(pos, key=pos.get)
-    return max_pos
-
-
 def get_subcounts(pos_c, max_p, ext=5):
     """Return shrunk positional distribution.
 
@@ -468,85 +1334,222 @@ def get_subcounts(pos_c, max_p, ext=5):
     return pos_c_out
 
 
-def mask_positions(pos_c, k_length, mask_l=100, mask_r=100):
-    """Return positional counts with removed positions around crosslinks."""
-    shift = int((k_length + 1) / 2)
-    mask = list(range(-mask_l + shift, mask_r + shift))
-    for _, value in pos_c.items():
-        for pos in mask:
-            value.pop(pos, None)
-    return pos_c
+def get_top_n_indices(values, num):
+    """Get indices of ``num`` largest values in descending order.
 
+    Only the largest values are sorted. Ties are ordered by index, also at
+    the cutoff, where values tied with the last selected value are taken in
+    order of index. NaN values are ranked last.
+    """
+    values = np.where(np.isnan(values), -np.inf, values)
+    num = min(num, len(values))
+    if num == 0:
+        return np.array([], dtype=np.int64)
+    cutoff = -np.partition(-values, num - 1)[num - 1]
+    above = np.nonzero(values > cutoff)[0]
+    top = np.concatenate([above, np.nonzero(values == cutoff)[0][:num - len(above)]])
+    return top[np.lexsort((top, -values[top]))]
+
+
+def get_mask_groups(mask):
+    """Yield indices of rows of 2D boolean mask that have the same mask."""
+    if len(mask) == 0:
+        return
+    _, inverse = np.unique(np.packbits(mask, axis=1), axis=0, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    yield from np.split(order, np.nonzero(np.diff(inverse.ravel()[order]))[0] + 1)
 
-def get_average_poscount(pos_c):
-    """Return average of positional counts."""
-    avg = {}
-    for key, value in pos_c.items():
-        avg[key] = sum(value.values()) / len(value)
-    total_counts = sum(avg.values())
-    for key, value in avg.items():
-        try:
-            avg[key] = value / total_counts
-        except ZeroDivisionError:
-            avg[key] = value
-    return avg
 
+def get_masked_mean(values, mask):
+    """Return mean of values on masked positions for each row.
 
-def get_top_n_kmers(kmer_count, num):
-    """Get a list of top_n most frequent kmers."""
-    return [item[0] for item in sorted(kmer_count.items(), key=lambda x: x[1], reverse=True)[:num]]
+    Rows with the same mask are averaged together, so means are the same as
+    ``np.mean`` of masked values of each row separately.
+    """
+    means = np.full(len(values), np.nan)
+    for rows in get_mask_groups(mask):
+        means[rows] = values[rows][:, mask[rows[0]]].mean(axis=1)
+    return means
+
+
+def get_masked_positions(mask, positions):
+    """Return masked positions of each row joined in a string."""
+    joined = np.empty(len(mask), dtype=object)
+    for rows in get_mask_groups(mask):
+        joined[rows] = ', '.join(str(pos) for pos in np.array(positions)[mask[rows[0]]])
+    return joined.tolist()
+
+
+def get_kmer_stats(counts, ref_counts, ntxn, noxn, k_length, window, window_distal, min_relativ_occurence,
+                   occ_positions):
+    """Calculate statistics of kmers from their positional counts.
+
+    Rows of ``counts`` are kmer counts on positions around thresholded
+    crosslinks (``window_distal``) and rows of ``ref_counts`` counts of the
+    same kmers around reference crosslinks (``window``). Return dictionary
+    of arrays: position of maximal count (mtxn), average distal occurence
+    (distal_occ), mask of relevant positions (prtxn_mask), average relative
+    occurences around thresholded and reference crosslinks (artxn, aroxn),
+    enrichment (etxn), normalization of counts on relevant positions (norm)
+    and occurences per 100 thresholded crosslinks on ``occ_positions``
+    (occ). Counts are sliced to needed positions before they are divided, so
+    no other array is as large as ``counts``.
+    """
+    shift = int((k_length + 1) / 2)
+    positions_distal = np.array(get_positions(k_length, window_distal))
+    positions = np.array(get_positions(k_length, window))
+    peak = (positions_distal >= -15) & (positions_distal <= 15)
+    mtxn = positions_distal[peak][np.argmax(counts[:, peak], axis=1)] if len(counts) else np.array([], dtype=int)
+    distal = ~np.isin(positions_distal, range(-100 + shift, 100 + shift))
+    # distal counts are total counts without counts on (few) masked positions
+    distal_occ = (counts.sum(axis=1) - counts[:, ~distal].sum(axis=1)) / distal.sum()
+    occ = distal_occ[:, None]
+    offset = window_distal - window
+    counts_window = counts[:, offset:offset + len(positions)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rtxn = np.where(occ == 0, counts_window, counts_window / occ)
+        roxn = np.where(occ == 0, ref_counts * ntxn / noxn, ref_counts * ntxn / (occ * noxn))
+    window_inner = int(window / 3)
+    inner = np.isin(positions, range(-window_inner + shift, window_inner + 1 + shift))
+    prtxn_mask = inner | (rtxn > min_relativ_occurence)
+    artxn = get_masked_mean(rtxn, prtxn_mask)
+    aroxn = get_masked_mean(roxn, prtxn_mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        etxn = np.log2(artxn / aroxn)
+    return {
+        'mtxn': mtxn,
+        'distal_occ': distal_occ,
+        'prtxn_mask': prtxn_mask,
+        'artxn': artxn,
+        'aroxn': aroxn,
+        'etxn': etxn,
+        'norm': np.where(distal_occ == 0, 1, distal_occ) * prtxn_mask.sum(axis=1),
+        'occ': counts[:, np.searchsorted(positions_distal, occ_positions)] * 100 / ntxn,
+    }
+
+
+def smooth_positions(df_in, smoot):
+    """Smoothen positional distribution in each column with triangular window.
+
+    Same as ``rolling(smoot, center=True, win_type='triang').mean()``
+    without edge rows, that would get NaN, and one more row at the end, but
+    computed as a convolution on array.
+    """
+    values = df_in.values.astype(np.float64)
+    weights = get_window('triang', smoot, fftbins=False)
+    weights = weights / weights.sum()
+    n_rows = max(len(values) - 2 * (smoot // 2) - 1, 0)
+    smooth = np.zeros((n_rows, values.shape[1]))
+    for i, weight in enumerate(weights):
+        smooth += weight * values[i:i + n_rows]
+    return pd.DataFrame(smooth, index=df_in.index[smoot // 2:smoot // 2 + n_rows], columns=df_in.columns)
+
+
+def get_kmeans(n_clusters, large=False):
+    """Return k-means estimator, mini-batch k-means if there are many kmers."""
+    if large:
+        return MiniBatchKMeans(n_clusters=n_clusters, random_state=4242, batch_size=1024, n_init=3)
+    return KMeans(n_clusters=n_clusters, random_state=4242)
+
+
+def select_n_clusters(principal_components, large=False, max_clusters=MAX_CLUSTERS):
+    """Choose number of clusters of kmers with the highest silhouette score.
+
+    Numbers of clusters from 2 to ``max_clusters`` are tried on the same
+    principal components. If there are many kmers, silhouette score is
+    estimated on a random sample of ``SILHOUETTE_SAMPLE`` kmers. Return
+    number of clusters and cluster labels of kmers.
+    """
+    n_kmers = len(principal_components)
+    best = 1, np.zeros(n_kmers, dtype=int)
+    best_score = -np.inf
+    sample_size = SILHOUETTE_SAMPLE if n_kmers > SILHOUETTE_SAMPLE else None
+    for n_clusters in range(2, min(max_clusters, n_kmers - 1) + 1):
+        labels = get_kmeans(n_clusters, large).fit_predict(principal_components)
+        if len(np.unique(labels)) < 2:
+            continue
+        score = silhouette_score(principal_components, labels, sample_size=sample_size, random_state=4242)
+        if score > best_score:
+            best, best_score = (n_clusters, labels), score
+    return best
 
 
 def get_clustering(kmer_pos_count, clustering_pm, smoot=6, clust=3):
     """Smoothen positional data for each kmer and then cluster kmers.
 
-    Prior to clustering PCA is ran to reduce number of dimensions. Return smooth
+    Prior to clustering PCA is ran to reduce number of dimensions. If there
+    are more than ``LARGE_CLUSTERING`` kmers, randomized PCA and mini-batch
+    k-means are used. If ``clust`` is 'auto', number of clusters is chosen
+    by silhouette score (see ``select_n_clusters``). Return smooth
     dataframe and a dictionary of cluster with belonging kmers.
     """
-    # read kmer_pos_count dictionary into a data frame
-    df_in = pd.DataFrame(kmer_pos_count)
-    # smoothen
-    df_smooth = df_in.rolling(smoot, center=True, win_type='triang').mean()
-    # slicing drops edge values that get NaN due to rolling mean
-    df_smooth = df_smooth.iloc[int(smoot / 2): -(int(smoot / 2) + 1), :]
-    df_t = df_smooth.T
+    # read kmer_pos_count dictionary into a data frame and smoothen
+    df_smooth = smooth_positions(pd.DataFrame(kmer_pos_count), smoot)
     df_cl = pd.DataFrame(clustering_pm).T
-    df_cl = df_cl[df_cl.index.isin(df_t.index)]
-    pca = PCA(n_components=4, svd_solver='full')
-    principal_components = pca.fit_transform(df_cl)
-    principal_df = pd.DataFrame(
-        data=principal_components,
-        columns=['principal component 1', 'principal component 2', 'principal component 3', 'principal component 4'])
-    kmeans = KMeans(n_clusters=clust, random_state=4242).fit(principal_df)
+    df_cl = df_cl[df_cl.index.isin(df_smooth.columns)]
+    large = len(df_cl) > LARGE_CLUSTERING
+    if large:
+        pca = PCA(n_components=4, svd_solver='randomized', random_state=4242)
+    else:
+        pca = PCA(n_components=4, svd_solver='full')
+    principal_components = pca.fit_transform(df_cl.values)
+    if clust == 'auto':
+        clust, labels = select_n_clusters(principal_components, large)
+    else:
+        labels = get_kmeans(clust, large).fit_predict(principal_components)
     # append lists of kmers belonging to each cluster
     df_map = pd.DataFrame()
     df_map['data_index'] = df_cl.index.values
-    df_map['cluster'] = kmeans.labels_
+    df_map['cluster'] = labels
     c_dict = {}
     for i in range(clust):
         c_dict['cluster' + str(i)] = df_map[df_map.cluster == i].set_index('data_index').index.values
     return df_smooth, c_dict
 
 
-def substrings(string):
-    """Return set of substrings of a string."""
-    return {string[x:y] for x, y in combinations(range(len(string) + 1), r=2)}
+def get_kmer_substrings(kmer, length):
+    """Return set of substrings of given length of a kmer."""
+    return {kmer[i:i + length] for i in range(len(kmer) - length + 1)}
 
 
-def get_all_substrings(string_list):
-    """Return set of all substring in a list of string."""
-    return {item for subset in [substrings(string) for string in string_list] for item in subset}
+def get_longest_common_substrings(kmer_list):
+    """Return sorted list of longest substrings common to all kmers in a list.
 
-
-def find_common_substrings(substring_set, string_list):
-    """Return set substring common to all strings in a list of strings."""
-    return {s for s in substring_set if all(s in sublist for sublist in string_list)}
-
-
-def get_longest_substrings(string_set):
-    """Return list of strings of maximal length in a set of strings."""
-    longest = len(max(string_set, key=lambda x: len(x)))
-    return [x for x in string_set if len(x) == longest]
+    Substrings of the first kmer are candidates. Starting with the longest
+    ones, candidates of each length are intersected with sets of substrings
+    of the same length of other kmers until some are common to all kmers.
+    """
+    for length in range(min(len(kmer) for kmer in kmer_list), 0, -1):
+        common = get_kmer_substrings(kmer_list[0], length)
+        for kmer in kmer_list[1:]:
+            common &= get_kmer_substrings(kmer, length)
+            if not common:
+                break
+        if common:
+            return sorted(common)
+    return []
+
+
+def get_substring_index(kmer_list, length):
+    """Return 2D array of bytes of distinct substrings of given length of each kmer."""
+    substrings = [substring for kmer in kmer_list for substring in get_kmer_substrings(kmer, length)]
+    return np.frombuffer(''.join(substrings).encode(), dtype=np.uint8).reshape(len(substrings), length)
+
+
+def score_consensus(consensus, substring_index):
+    """Return number of kmer substrings matching degenerate consensus.
+
+    Consensus is a list of allowed bases on each position. The score is the
+    number of pairs of a kmer and a sequence of bases allowed by consensus,
+    that is a substring of the kmer. It is obtained by matching consensus
+    to distinct substrings of the same length of each kmer in
+    ``substring_index`` (see ``get_substring_index``), without enumerating
+    sequences allowed by consensus.
+    """
+    allowed = np.zeros((len(consensus), 256), dtype=bool)
+    for pos, bases in enumerate(consensus):
+        allowed[pos, np.frombuffer(''.join(bases).encode(), dtype=np.uint8)] = True
+    return int(np.all(allowed[np.arange(len(consensus)), substring_index], axis=1).sum())
 
 
 def get_index(substring, kmer_list):
@@ -622,14 +1625,12 @@ def chose_best_consensus(consensuses, kmer_list):
     """Return best consensus found in the list of consensuses."""
     if len(consensuses) == 1:
         return consensuses[0]
+    substring_indices = {}
     score_dict = {}
     for i, consensus in enumerate(consensuses):
-        score = 0
-        for combo in product(*consensus):
-            for kmer in kmer_list:
-                if ''.join(combo) in kmer:
-                    score += 1
-        score_dict[i] = score
+        if len(consensus) not in substring_indices:
+            substring_indices[len(consensus)] = get_substring_index(kmer_list, len(consensus))
+        score_dict[i] = score_consensus(consensus, substring_indices[len(consensus)])
     max_score = max(score_dict.values())
     top_scored = [consensuses[k] for k, v in score_dict.items() if v == max_score]
     if len(top_scored) == 1:
@@ -674,12 +1675,10 @@ def get_clusters_name(c_dict):
             # if there is only one kmer in a cluster than cluster name is kmer
             c_con_dict[cluster_id] = kmers_list[0]
         elif len(kmers_list) > 1:
-            all_substrings = get_all_substrings(kmers_list)
-            common_substrings = find_common_substrings(all_substrings, kmers_list)
-            if not common_substrings:
+            longest_subtring = get_longest_common_substrings(kmers_list)
+            if not longest_subtring:
                 c_con_dict[cluster_id] = kmers_list[0]
             else:
-                longest_subtring = get_longest_substrings(common_substrings)
                 matrices = get_matrices(longest_subtring, kmers_list)
                 consensuses = []
                 for matrix in matrices.values():
@@ -721,7 +1720,10 @@ def plot_positional_distribution(df_in, df_sum, c_dict, c_rank, name, cluster_re
     """Plot each cluster on its own plot.
 
     Also, plot combining the averages of clusters over a larger window.
+    Plotting libraries are imported only when plots are drawn.
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     c_num = len(c_dict)
     num_rows = int(np.ceil((c_num + 1) / 2)) if c_num > 1 else 2
     sns.set(rc={'figure.figsize': (24, num_rows * 7)})
@@ -754,10 +1756,484 @@ def plot_positional_distribution(df_in, df_sum, c_dict, c_rank, name, cluster_re
     axs[axs_x_sumplt, axs_y_sumplt].set_xlim(-150, 100)
     sns.lineplot(data=df_ordered, ax=axs[axs_x_sumplt, axs_y_sumplt], ci=None, **lineplot_kwrgs)
     fig.savefig(f'./results/{name}_{region}.pdf', format='pdf')
+    plt.close(fig)
+
+
+def get_split_dict(df_in):
+    """Return DataFrame as dictionary of index, columns and data with JSON serializable values."""
+    return {'index': df_in.index.tolist(), 'columns': df_in.columns.tolist(), 'data': df_in.values.tolist()}
+
+
+def write_plot_data(df_smooth, df_sum, c_dict, c_rank, name, cluster_rename, region):
+    """Write data of plots of a region to JSON file and return its path.
+
+    Plots are drawn from it later with ``render_plot``.
+    """
+    plot_file = f'./results/{name}_{region}_plot_data.json'
+    with open(plot_file, 'w') as file:
+        json.dump({
+            'smooth': get_split_dict(df_smooth),
+            'sum': get_split_dict(df_sum),
+            'clusters': {cluster: list(kmers) for cluster, kmers in c_dict.items()},
+            'rank': c_rank,
+            'rename': cluster_rename,
+            'name': name,
+            'region': region,
+        }, file)
+    return plot_file
+
+
+def render_plot(plot_file, context=None):
+    """Draw plots of a region from data written by ``write_plot_data``."""
+    with open(plot_file) as file:
+        data = json.load(file)
+    plot_positional_distribution(
+        pd.DataFrame(**data['smooth']), pd.DataFrame(**data['sum']), data['clusters'], data['rank'], data['name'],
+        data['rename'], data['region'])
+
+
+def render_plots(plot_files=None, workers=1):
+    """Draw plots from data files in parallel processes.
+
+    If plot files are not given, plots are drawn for all data files in
+    results directory.
+    """
+    if plot_files is None:
+        plot_files = sorted(glob.glob('./results/*_plot_data.json'))
+    render_start = time.time()
+    map_tasks(render_plot, plot_files, None, workers=workers)
+    print(f'Rendering {len(plot_files)} plots runtime: {((time.time() - render_start) / 60):.2f} min')
+
+
+def get_feature_counts(df_sites, df_xn_feature, complement, genome_store, window, window_distal, kmer_lengths,
+                       sparse=False):
+    """Count kmers around thresholded and reference crosslinks of a feature.
+
+    Reference crosslinks are all crosslinks of a feature that are not in
+    peaks. Sequence windows are extracted once for the longest of
+    ``kmer_lengths`` and kmers of all lengths are counted from them. Return
+    dictionary with numbers of thresholded (ntxn) and reference (noxn)
+    crosslinks, reference crosslinks, encoded windows around reference
+    crosslinks as a single uint8 array with a row for each crosslink
+    (ref_windows) and dictionaries with kmer lengths as keys of positional
+    counts around thresholded (counts) and reference crosslinks
+    (ref_counts). If sparse, positional counts are given only for kmers
+    that are present (see ``count_codes_sparse``).
+    """
+    k_max = max(kmer_lengths)
+    bed6 = ['chrom', 'start', 'end', 'name', 'score', 'strand']
+    df_reference = get_reference(df_xn_feature[bed6], complement)
+    # get sequences around all crosslinks not in peaks
+    ref_windows = get_windows(
+        genome_store, df_reference['chrom'].values, df_reference['start'].values, df_reference['strand'].values,
+        window + k_max, window + k_max)
+    # get sequences around all thresholded crosslinks
+    windows = get_windows(
+        genome_store, df_sites['chrom'].values, df_sites['start'].values, df_sites['strand'].values,
+        window_distal + k_max, window_distal + k_max)
+    return {
+        'ntxn': len(df_sites),
+        'noxn': len(df_reference),
+        'counts': pos_count_encoded_lengths(windows, kmer_lengths, window_distal, sparse=sparse),
+        'ref_counts': pos_count_encoded_lengths(ref_windows, kmer_lengths, window, sparse=sparse),
+        'ref_windows': ref_windows,
+        'reference': df_reference,
+    }
+
+
+def add_counts(counts):
+    """Sum list of dense or sparse positional counts."""
+    if isinstance(counts[0], tuple):
+        return sum_sparse_counts(counts)
+    return sum(counts)
+
+
+def sum_feature_counts(features_counts):
+    """Combine kmer counts of several features into counts of a region."""
+    kmer_lengths = features_counts[0]['counts'].keys()
+    return {
+        'ntxn': sum(counts['ntxn'] for counts in features_counts),
+        'noxn': sum(counts['noxn'] for counts in features_counts),
+        'counts': {k: add_counts([counts['counts'][k] for counts in features_counts]) for k in kmer_lengths},
+        'ref_counts': {k: add_counts([counts['ref_counts'][k] for counts in features_counts]) for k in kmer_lengths},
+        'ref_windows': np.concatenate([counts['ref_windows'] for counts in features_counts]),
+        'reference': pd.concat([counts['reference'] for counts in features_counts], ignore_index=True),
+    }
+
+
+def sum_shards_counts(shards_counts):
+    """Combine kmer counts of shards of a feature into counts of the feature.
+
+    Reference crosslinks and windows around them are put back in the order
+    of crosslinks of the feature, so random samples of reference drawn with
+    the same seed do not depend on how crosslinks are split into shards.
+    """
+    order = np.argsort(np.concatenate([counts['reference'].index for counts in shards_counts]), kind='stable')
+    feature_counts = sum_feature_counts(shards_counts)
+    feature_counts['ref_windows'] = feature_counts['ref_windows'][order]
+    feature_counts['reference'] = feature_counts['reference'].iloc[order].reset_index(drop=True)
+    return feature_counts
+
+
+def init_worker(context):
+    """Store context of tasks in a worker process.
+
+    Workers are forked, so context is inherited from the parent process
+    instead of being pickled. Random state of each worker is reseeded, so
+    unseeded random samples differ between workers.
+    """
+    global WORKER_CONTEXT
+    WORKER_CONTEXT = context
+    random.seed()
+    np.random.seed()
+
+
+def run_worker_task(function, task):
+    """Run task in a worker process with context stored by ``init_worker``."""
+    return function(task, WORKER_CONTEXT)
+
+
+def map_tasks(function, tasks, context, workers=1):
+    """Return results of ``function(task, context)`` for each of the tasks.
+
+    With more than one worker tasks are run in a pool of forked processes
+    that share ``context`` with the parent process. Each worker runs a
+    single task, so memory used by a task is released when it finishes.
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        return [function(task, context) for task in tasks]
+    pool = multiprocessing.get_context('fork').Pool(
+        min(workers, len(tasks)), initializer=init_worker, initargs=(context,), maxtasksperchild=1)
+    try:
+        return pool.starmap(run_worker_task, [(function, task) for task in tasks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_shards(df_txn, df_xn, feature, shard_by=None):
+    """Return counting tasks of a feature, one for each shard of its crosslinks.
+
+    Crosslinks of a feature are split by values of ``shard_by`` column
+    (e.g. chrom or strand), a single task covers all of them if it is None.
+    """
+    if shard_by is None:
+        return [(feature, None)]
+    values = set(df_txn.loc[df_txn['feature'] == feature, shard_by]) | set(
+        df_xn.loc[df_xn['feature'] == feature, shard_by])
+    return [(feature, value) for value in sorted(values)] or [(feature, None)]
+
+
+def count_feature(task, context):
+    """Count kmers around crosslinks of a feature (and shard) given in ``context``."""
+    feature, shard = task
+    counts_cp = time.time()
+    df_txn, df_xn = context['df_txn'], context['df_xn']
+    txn_mask = df_txn['feature'] == feature
+    xn_mask = df_xn['feature'] == feature
+    if shard is not None:
+        txn_mask &= df_txn[context['shard_by']] == shard
+        xn_mask &= df_xn[context['shard_by']] == shard
+    feature_counts = get_feature_counts(
+        df_txn.loc[txn_mask], df_xn.loc[xn_mask], context['complement'], context['genome_store'],
+        context['window'], context['window_distal'], context['kmer_lengths'], sparse=context['sparse'])
+    shard_name = feature if shard is None else f'{feature} ({shard})'
+    print(f'Kmer positional counting runtime on {shard_name}: {((time.time() - counts_cp) / 60):.2f} min')
+    return feature_counts
+
+
+def write_result_store(path, kmer_codes, stats, z_scores, p_values, positions, occ, occ_positions, meta):
+    """Write table of kmer results as a store of binary arrays.
+
+    Kmers are given by their integer codes, values of ``RESULT_COLUMNS``
+    are stored as float32 columns of a 2D array, relevant positions as a
+    mask over ``positions`` and occurences per thresholded crosslinks on
+    ``occ_positions`` as float32 2D array.
+    """
+    values = np.column_stack([stats['artxn'], stats['aroxn'], stats['etxn'], z_scores, p_values])
+    save_store(path, {
+        'kmer_codes': np.asarray(kmer_codes, dtype=np.int64),
+        'mtxn': np.asarray(stats['mtxn'], dtype=np.int32),
+        'values': values.astype(np.float32),
+        'prtxn_mask': stats['prtxn_mask'],
+        'positions': np.asarray(positions, dtype=np.int32),
+        'occ': np.asarray(occ, dtype=np.float32),
+        'occ_positions': np.asarray(occ_positions, dtype=np.int32),
+    }, dict(meta, columns=RESULT_COLUMNS))
+
+
+def analyse_region(task, context):
+    """Analyse kmers of given length around thresholded crosslinks of a region and write results.
+
+    Task is a pair of region and kmer length, parameters of the analysis
+    and kmer counts of features are given in ``context`` (see ``run``).
+    Return summary of the region with numbers of thresholded and reference
+    crosslinks, top kmers and names of clusters.
+    """
+    region, kmer_length = task
+    sample_name = context['sample_name']
+    # names of outputs that are not named by kmer length include it when
+    # kmers of several lengths are analysed
+    output_name = sample_name if len(context['kmer_lengths']) == 1 else f'{sample_name}_{kmer_length}mer'
+    window = context['window']
+    window_distal = context['window_distal']
+    min_relativ_occurence = context['min_relativ_occurence']
+    null = context['null']
+    region_start = time.time()
+    region_counts = sum_feature_counts([context['features_counts'][feature] for feature in REGION_SITES[region]])
+    noxn = region_counts['noxn']
+    print(f'noxn {noxn} on {region}')
+    ntxn = region_counts['ntxn']
+    print(f'ntxn {ntxn} on {region}')
+    if context['all_outputs'] and kmer_length == context['kmer_lengths'][0]:
+        region_counts['reference'].to_csv(
+            f'./results/{sample_name}_oxn_{region}.bed', sep='\t', header=None, index=None)
+    n_pos_distal = 2 * window_distal + 1
+    if context['sparse']:
+        # only kmers present around thresholded crosslinks are analysed
+        kmer_codes = get_sparse_kmers(region_counts['counts'][kmer_length], n_pos_distal)
+        counts = get_sparse_rows(region_counts['counts'][kmer_length], kmer_codes, n_pos_distal)
+        ref_counts = get_sparse_rows(region_counts['ref_counts'][kmer_length], kmer_codes, 2 * window + 1)
+    else:
+        kmer_codes = np.arange(4 ** kmer_length)
+        counts = region_counts['counts'][kmer_length]
+        ref_counts = region_counts['ref_counts'][kmer_length]
+    kmers = decode_kmers(kmer_codes, kmer_length)
+    # relative occurences of kmers on relevant positions around thresholded
+    # and reference crosslinks, relevant positions are those around
+    # crosslinks where relative occurence is higher then minimal relative
+    # occurence (default 2), kmer occurences per thresholded crosslinks are
+    # kept on positions around -50 to 50 that are added to outfile table
+    exported_columns = list(range(-48, 51))
+    stats = get_kmer_stats(
+        counts, ref_counts, ntxn, noxn, kmer_length, window, window_distal, min_relativ_occurence,
+        exported_columns)
+    prtxn_cp = time.time()
+    # for z-score calculation random samples from crosslink out of peaks
+    # (reference) are used, or mean and standard deviation of such samples
+    # are calculated analytically
+    relevant_codes = partial(
+        get_relevant_window_codes, k_length=kmer_length, window=window, prtxn_mask=stats['prtxn_mask'],
+        kmer_codes=kmer_codes if context['sparse'] else None)
+    null_avg, null_std, analytic = get_null_model(
+        region_counts['ref_windows'], relevant_codes, ntxn, stats['norm'], null, seed=context['seed'])
+    print(f'Null model ({null}) runtime: {((time.time() - prtxn_cp) / 60):.2f} min')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = (stats['artxn'] - null_avg) / null_std
+    p_values = scipy.special.ndtr(-z_scores)
+    table_name = f'./results/{sample_name}_{kmer_length}mer_{region}'
+    if context['tables'] in ['tsv', 'both']:
+        df_out = pd.DataFrame({
+            'mtxn': stats['mtxn'],
+            'prtxn': get_masked_positions(stats['prtxn_mask'], get_positions(kmer_length, window)),
+            'artxn': stats['artxn'],
+            'aroxn': stats['aroxn'],
+            'etxn': stats['etxn'],
+            'z-score': z_scores,
+            'p-value': p_values,
+        }, index=kmers)
+        df_occ = pd.DataFrame(stats['occ'], index=kmers, columns=exported_columns)
+        df_out = pd.concat([df_out, df_occ], axis=1)
+        df_out.to_csv(f'{table_name}.tsv', sep='\t', float_format='%.8f')
+    if context['tables'] in ['binary', 'both']:
+        # binary table with float32 values and integer kmer codes, which can
+        # be memory-mapped for aggregation across samples (see load_results)
+        write_result_store(
+            f'{table_name}.kmers', kmer_codes, stats, z_scores, p_values, get_positions(kmer_length, window),
+            stats['occ'], exported_columns,
+            {'sample': sample_name, 'region': region, 'kmer_length': kmer_length})
+    if null == 'check':
+        df_check = get_null_check(kmers, dict(zip(kmers, stats['artxn'])), null_avg, null_std, *analytic)
+        df_check.to_csv(
+            f'./results/{sample_name}_{kmer_length}mer_{region}_null_check.tsv', sep='\t', float_format='%.8f')
+    # top kmers by z-score are selected without sorting all kmers
+    top = get_top_n_indices(z_scores, context['top_n'])
+    top_kmers = [kmers[i] for i in top]
+    z_score = dict(zip(top_kmers, z_scores[top]))
+    # occurences on all positions are needed only for plots of top kmers
+    positions_distal = get_positions(kmer_length, window_distal)
+    plot_selection = {
+        kmers[i]: dict(zip(positions_distal, (counts[i] * 100 / ntxn).tolist())) for i in top}
+    kmer_occ_per_txl_ln = {
+        kmers[i]: dict(zip(exported_columns, np.log(stats['occ'][i] + 1).tolist())) for i in sorted(top)}
+    df_smooth, clusters_dict = get_clustering(
+        plot_selection, kmer_occ_per_txl_ln, context['smoothing'], context['clusters'])
+    # for meta analysis clusters are also output in a file
+    with open(f'./results/{output_name}_{region}_clusters.csv', 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        for key, val in clusters_dict.items():
+            writer.writerow([key, val])
+    # calculating average occurences for the last plot that displays average
+    # occurences for each cluster over wider window, also output as a file
+    df_cluster_sum = get_cluster_wide_sum(plot_selection, clusters_dict)
+    sum_name = '{}_sum_cluster_distribution_{}.tsv'.format(output_name, region)
+    # find cluster with max average peak value, rank clusters by this value
+    # and plot clusters in order using thie rank
+    clusters_max = {cluster: max(df_cluster_sum[cluster]) for cluster in df_cluster_sum.columns}
+    clusters_rank = {
+        key: rank for rank, key in enumerate(sorted(clusters_max, key=clusters_max.get, reverse=True), 1)}
+    # using positions and occurences each cluster gets a name
+    cluster_rename = get_clusters_name(clusters_dict)
+    df_cluster_sum.rename(columns=cluster_rename).to_csv('./results/' + sum_name, sep='\t')
+    # data for plots of all the clusters and the wider window (-150 to 100)
+    # plot with average occurences, which are drawn after all regions are
+    # analysed (see render_plots)
+    plot_file = write_plot_data(
+        df_smooth, df_cluster_sum, clusters_dict, clusters_rank, output_name, cluster_rename, region)
+    plot_cp = time.time()
+    print(f'Analysing {region} ({kmer_length}mer) runtime: {((plot_cp - region_start) / 60):.2f}')
+    print(f'Analysing {region} in seconds per thresholded_crosslink: {(plot_cp - region_start) / ntxn}')
+    return {
+        'sample': sample_name,
+        'region': region,
+        'kmer_length': kmer_length,
+        'ntxn': ntxn,
+        'noxn': noxn,
+        'top_kmer': top_kmers[0] if top_kmers else '',
+        'top_z_score': z_score[top_kmers[0]] if top_kmers else np.nan,
+        'top_kmers': ', '.join(top_kmers),
+        'clusters': ', '.join(cluster_rename[cluster] for cluster in sorted(clusters_rank, key=clusters_rank.get)),
+        'plot_data': plot_file,
+    }
+
+
+def load_results(path):
+    """Return memory-mapped arrays and metadata of binary table of kmer results.
+
+    Table is written by ``write_result_store``, metadata include sample,
+    region, kmer length and names of columns of values. ValueError is
+    raised for missing tables and tables written by other versions.
+    """
+    meta = get_store_meta(path)
+    if meta is None:
+        raise ValueError(f'No binary table of kmer results in {path}.')
+    if meta.get('version') != STORE_VERSION:
+        raise ValueError(f'Binary table of kmer results in {path} was written by another version, rerun analysis.')
+    meta = {key: value for key, value in meta.items() if key != 'version'}
+    return load_store(path, meta), meta
+
+
+def get_results_table(path):
+    """Return binary table of kmer results as DataFrame with the same columns as TSV table."""
+    results, meta = load_results(path)
+    kmers = decode_kmers(results['kmer_codes'], meta['kmer_length'])
+    df_out = pd.DataFrame({'mtxn': results['mtxn'], 'prtxn': get_masked_positions(
+        results['prtxn_mask'], results['positions'].tolist())}, index=kmers)
+    df_values = pd.DataFrame(results['values'], index=kmers, columns=meta['columns'])
+    df_occ = pd.DataFrame(results['occ'], index=kmers, columns=results['occ_positions'].tolist())
+    return pd.concat([df_out, df_values, df_occ], axis=1)
+
+
+def aggregate_results(paths, column='z-score'):
+    """Combine a column of binary tables of kmer results of several samples or regions.
+
+    Tables are aligned on kmer codes, so kmers missing in some tables (e.g.
+    with sparse counting) get NaN. Return DataFrame with kmers as index and
+    a column named by sample and region for each table.
+    """
+    tables = [load_results(path) for path in paths]
+    kmer_lengths = {meta['kmer_length'] for _, meta in tables}
+    assert len(kmer_lengths) == 1, 'Tables of results need to be of the same kmer length.'
+    kmer_codes = np.unique(np.concatenate([results['kmer_codes'] for results, _ in tables]))
+    values = np.full((len(kmer_codes), len(tables)), np.nan, dtype=np.float32)
+    for i, (results, meta) in enumerate(tables):
+        rows = np.searchsorted(kmer_codes, results['kmer_codes'])
+        values[rows, i] = results['values'][:, meta['columns'].index(column)]
+    return pd.DataFrame(
+        values, index=decode_kmers(kmer_codes, kmer_lengths.pop()),
+        columns=['{}_{}'.format(meta['sample'], meta['region']) for _, meta in tables])
+
+
+def prepare_shared(genome, genome_fai, regions_file, temp_path, cache_dir=CACHE_DIR):
+    """Prepare inputs shared by analyses of all samples.
+
+    Return dictionary with compiled regions used for thresholding
+    (annotation), genome store, path of chromosome sizes file (chr_sizes)
+    written to ``temp_path`` and cache directory.
+    """
+    genome_chr_sizes = os.path.join(temp_path, 'genome.sizes')
+    cut = local["cut"]
+    make_genome_sz = cut("-f1,2", genome_fai)
+    with open(genome_chr_sizes, 'w') as file:
+        file.write(make_genome_sz)
+    return {
+        'annotation': get_annotation_index(regions_file, cache_dir=cache_dir),
+        'genome_store': get_genome_store(genome, genome_fai, cache_dir=cache_dir),
+        'chr_sizes': genome_chr_sizes,
+        'cache_dir': cache_dir,
+    }
+
+
+def run_sample(peak_file, sites_file, sample_name, shared, window, window_distal, kmer_length, top_n, percentile,
+               min_relativ_occurence, clusters, smoothing, all_outputs=False, regions=None, seed=None,
+               null='bootstrap', workers=1, shard_by=None, sparse=False, memory_budget=MEMORY_BUDGET, tables='tsv'):
+    """Analyse kmers of a single sample using inputs ``shared`` by all samples.
+
+    Shared inputs are obtained with ``prepare_shared``, for description of
+    other parameters see ``run``. Return list of summaries of analysed
+    regions.
+    """
+    start = time.time()
+    if regions is None:
+        regions = REGIONS
+    kmer_lengths = sorted(set(kmer_length)) if isinstance(kmer_length, (list, tuple)) else [kmer_length]
+    print('Annotating crosslinks')
+    df_annotated = annotate_bed6(
+        sites_file, shared['annotation'], memory_budget=memory_budget, cache_dir=shared['cache_dir'])
+    print(f'Annotation runtime: {((time.time() - start) / 60):.2f} min for {len(df_annotated)} crosslinks')
+    print('Getting thresholded crosslinks')
+    df_txn = get_threshold_sites(df_annotated, percentile=percentile)
+    if df_txn is None:
+        print("Not able to find any thresholded sites.")
+        return []
+    print(f'Thresholding runtime: {((time.time() - start) / 60):.2f} min for {len(df_txn)} thresholded crosslinks')
+    df_txn = remove_chr(df_txn, shared['chr_sizes'])
+    checkpoint1 = time.time()
+    df_xn = get_all_sites(df_annotated)
+    print(f'{len(df_xn)} total sites. All sites taging runtime: {((time.time() - checkpoint1) / 60):.2f} min')
+    # kmer counts are additive, so each feature is counted only once and
+    # counts of regions composed of several features are obtained by summation
+    region_ntxn = {}
+    for region in regions:
+        # Parse sites file and keep only parts that intersect with given region
+        df_sites = df_txn.loc[df_txn['feature'].isin(REGION_SITES[region])]
+        region_ntxn[region] = len(df_sites)
+        print(f'{len(df_sites)} thresholded sites on {region}')
+        if all_outputs:
+            df_sites[['chrom', 'start', 'end', 'name', 'score', 'strand']].to_csv(
+                f'./results/{sample_name}_threshold_crosslinks_{region}.bed', sep='\t', header=None, index=None)
+    # only continue analysis for regions with over 100 thresholded sites
+    for region in [region for region in regions if region_ntxn[region] < 100]:
+        print(f'less then 100 thresholded crosslink in {region}')
+    regions = [region for region in regions if region_ntxn[region] >= 100]
+    # finds all crosslink sites that are not in peaks as reference for
+    # normalization
+    complement = get_complement_cached(peak_file, shared['chr_sizes'], cache_dir=shared['cache_dir'])
+    features = sorted({feature for region in regions for feature in REGION_SITES[region]})
+    features_context = {
+        'df_txn': df_txn, 'df_xn': df_xn, 'complement': complement, 'genome_store': shared['genome_store'],
+        'window': window, 'window_distal': window_distal, 'kmer_lengths': kmer_lengths, 'shard_by': shard_by,
+        'sparse': sparse}
+    # counts of shards are computed separately and summed for each feature
+    tasks = [task for feature in features for task in get_shards(df_txn, df_xn, feature, shard_by)]
+    shards_counts = map_tasks(count_feature, tasks, features_context, workers=workers)
+    features_counts = {
+        feature: sum_shards_counts([
+            counts for (task_feature, _), counts in zip(tasks, shards_counts) if task_feature == feature])
+        for feature in features}
+    context = {
+        'sample_name': sample_name, 'kmer_lengths': kmer_lengths, 'window': window, 'window_distal': window_distal,
+        'top_n': top_n, 'min_relativ_occurence': min_relativ_occurence, 'clusters': clusters,
+        'smoothing': smoothing, 'all_outputs': all_outputs, 'seed': seed, 'null': null, 'sparse': sparse,
+        'tables': tables, 'features_counts': features_counts}
+    tasks = [(region, k_length) for region in regions for k_length in kmer_lengths]
+    return map_tasks(analyse_region, tasks, context, workers=workers)
 
 
 def run(peak_file, sites_file, genome, genome_fai, regions_file, window, window_distal, kmer_length, top_n,
-        percentile, min_relativ_occurence, clusters, smoothing, all_outputs=False, regions=None):
+        percentile, min_relativ_occurence, clusters, smoothing, all_outputs=False, regions=None, seed=None,
+        null='bootstrap', cache_dir=CACHE_DIR, workers=1, shard_by=None, sparse=False,
+        memory_budget=MEMORY_BUDGET, plots=True, tables='tsv'):
     """Start the analysis.
 
     Description of parameters:
@@ -770,255 +2246,249 @@ def run(peak_file, sites_file, genome, genome_fai, regions_file, window, window_
       distributions are obtained by counting kmers per position (default 40)
     - window_distal: region considered for background distribution (default 150)
     - kmer_length: length (in nucleotides) of kmers to be analysed (default 4,
-      with option between 3 and 7)
+      with option between 3 and 7), or a list of lengths that are all
+      analysed from the same thresholded crosslinks and sequences
     - top_n: number of kmers ranked by z-score in descending order for
       clustering and plotting (default 20)
     - percentile: used for thresholding crosslinks (default 0.7)
     - min_relative_occurence: ratio of kmer distribution around (thresholded)
       crosslinks to distal occurrences (default 2)
-    - clusters: number of clusters of kmers(default 5)
+    - clusters: number of clusters of kmers(default 5), or 'auto' to choose
+      it by silhouette score
     - smoothing: window used for smoothing kmer positional distribution curves
     (default 6)
     - all_outputs: controls the amount of outputs produced in the analysis
+    - seed: seed for drawing random samples of reference crosslinks used
+      for z-score calculation, when not given global random state is used
+    - null: null model used for z-score calculation, either 'bootstrap'
+      (random samples of reference crosslinks), 'analytic' (exact mean and
+      standard deviation of random samples) or 'check' (bootstrap, but also
+      report differences to analytic null model)
+    - cache_dir: directory for caching results that can be reused across
+      runs, when None nothing is cached
+    - workers: number of processes used for counting kmers on features and
+      analysing regions in parallel (default 1)
+    - shard_by: split crosslinks of each feature by 'chrom' or 'strand' into
+      shards that are counted separately, so that counting is spread over
+      more workers and each of them holds fewer sequences, when None each
+      feature is counted as a whole
+    - sparse: count and analyse only kmers that are present around
+      thresholded crosslinks, which makes long kmers (up to 10) feasible,
+      output tables then contain only these kmers
+    - memory_budget: approximate memory in bytes used for reading crosslinks,
+      which are read and annotated in chunks of this size
+    - plots: draw plots after all regions are analysed, in ``workers``
+      parallel processes, when False only data of plots is written, plots
+      can be drawn from it later with ``render_plots``
+    - tables: format of tables of kmer results, 'tsv', 'binary' (store of
+      float32 arrays with integer kmer codes, see ``load_results``) or
+      'both'
     """
     start = time.time()
     if regions is None:
         regions = REGIONS
     assert set(regions).issubset(set(REGIONS))
-    sample_name = get_name(sites_file)
-    global TEMP_PATH
-    TEMP_PATH = './TEMP{}/'.format(randint(10 ** 6, 10 ** 7))
-    os.makedirs(TEMP_PATH)
+    assert null in NULL_MODELS
+    assert shard_by in SHARD_COLUMNS
+    assert tables in TABLE_FORMATS
+    temp_path = './TEMP{}/'.format(randint(10 ** 6, 10 ** 7))
+    os.makedirs(temp_path)
     os.makedirs('./results/', exist_ok=True)
-    get_regions_map(regions_file)
-    global REGIONS_MAP
-    REGIONS_MAP = {
-        'intron': '{}intron_regions.bed'.format(TEMP_PATH),
-        'intergenic': '{}intergenic_regions.bed'.format(TEMP_PATH),
-        'cds_utr_ncrna': '{}cds_utr_ncrna_regions.bed'.format(TEMP_PATH)}
-    print('Getting thresholded crosslinks')
-    df_txn = get_threshold_sites(sites_file, percentile=percentile)
-    print(f'Thresholding runtime: {((time.time() - start) / 60):.2f} min for {len(df_txn)} thresholded crosslinks')
-    if df_txn is None:
-        print("Not able to find any thresholded sites.")
-        return
-    genome_chr_sizes = '{}genome.sizes'.format(TEMP_PATH)
-    cut = local["cut"]
-    make_genome_sz = cut("-f1,2", genome_fai)
-    with open(genome_chr_sizes, 'w') as file:
-        file.write(make_genome_sz)
-    df_txn = remove_chr(df_txn, '{}genome.sizes'.format(TEMP_PATH))
-    checkpoint1 = time.time()
-    df_xn = get_all_sites(sites_file)
-    print(f'{len(df_xn)} total sites. All sites taging runtime: {((time.time() - checkpoint1) / 60):.2f} min')
-    for region in regions:
-        region_start = time.time()
-        # Parse sites file and keep only parts that intersect with given region
-        df_sites = df_txn.loc[df_txn['feature'].isin(REGION_SITES[region])]
-        print(f'{len(df_sites)} thresholded sites on {region}')
-        df_xn_region = df_xn.loc[df_xn['feature'].isin(REGION_SITES[region])]
-        print(f'{len(df_xn_region)} all sites on {region}')
-        sites = pbt.BedTool.from_dataframe(
-            df_sites[['chrom', 'start', 'end', 'name', 'score', 'strand']])
-        if all_outputs:
-            sites.saveas('./results/{}_threshold_crosslinks_{}.bed'.format(sample_name, region))
-        # only continue analysis for region with over 100 thresholded sites
-        if len(sites) < 100:
-            print(f'less then 100 thresholded crosslink in {region}')
-            continue
-        all_sites = pbt.BedTool.from_dataframe(df_xn_region[['chrom', 'start', 'end', 'name', 'score', 'strand']])
-        # finds all crosslink sites that are not in peaks as reference for
-        # normalization
-        complement = get_complement(peak_file, '{}genome.sizes'.format(TEMP_PATH))
-        # if region == 'whole_gene':
-        #     complement = intersect(REGIONS_MAP['whole_gene_reference'], complement)
-        reference = intersect(complement, all_sites)
-        noxn = len(reference)
-        print(f'noxn {noxn} on {region}')
-        ntxn = len(sites)
-        print(f'ntxn {ntxn} on {region}')
-        if all_outputs:
-            reference.saveas(f'./results/{sample_name}_oxn_{region}.bed')
-        # get sequences around all crosslinks not in peaks
-        reference_sequences = get_sequences(
-            reference, genome, genome_fai, window + kmer_length, window + kmer_length, merge_overlaps=False)
-        # get sequences around all thresholded crosslinks
-        sequences = get_sequences(sites, genome, genome_fai, window_distal + kmer_length, window_distal + kmer_length)
-        get_sequences_cp = time.time()
-        # get positional counts for all kmers around thresholded crosslinks
-        kmer_pos_count_t = pos_count_kmer(sequences, kmer_length, window_distal)
-        print(f'Kmer positional counting runtime: {((time.time() - get_sequences_cp) / 60):.2f} min')
-        kmer_pos_count = {key.replace('T', 'U'): value for key, value in kmer_pos_count_t.items()}
-        # get position where the kmer count is maximal
-        max_p = get_max_pos(kmer_pos_count, window_peak_l=15, window_peak_r=15)
-        # prepare dataframe for outfile
-        df_out = pd.DataFrame.from_dict(max_p, orient='index', columns=['mtxn'])
-        # get kmer counts in distal areas of thresholded crosslinks
-        kmer_pc_copy = copy.deepcopy(kmer_pos_count)
-        distal = mask_positions(kmer_pc_copy, kmer_length)
-        # calculate average distal occurences of kmers
-        avg_distal_occ = {}
-        for key, value in distal.items():
-            avg_distal_occ[key] = sum(value.values()) / len(value)
-        # occurences of kmers on each position around thresholded crosslinks
-        # relative to distal occurences
-        rtxn = {x: {} for x in kmer_pos_count}
-        for motif, pos_m in kmer_pos_count.items():
-            for pos, count in pos_m.items():
-                try:
-                    rtxn[motif][pos] = count / avg_distal_occ[motif]
-                except ZeroDivisionError:
-                    rtxn[motif][pos] = count
-        rtxn_cp = time.time()
-        # get positional counts for all kmers around all crosslink not in peaks
-        ref_pc_t = pos_count_kmer(reference_sequences, kmer_length, window)
-        print(f'Reference positional counts runtime: {((time.time() - rtxn_cp) / 60):.2f} min')
-        ref_pc = {key.replace('T', 'U'): value for key, value in ref_pc_t.items()}
-        # occurences of kmers on each position around all crosslinks not in
-        # peaks (reference) relative to distal occurences
-        roxn = {x: {} for x in ref_pc}
-        for motif, pos_m in ref_pc.items():
-            for pos, count in pos_m.items():
-                try:
-                    roxn[motif][pos] = (count * ntxn) / (avg_distal_occ[motif] * noxn)
-                except ZeroDivisionError:
-                    roxn[motif][pos] = (count * ntxn) / noxn
-        # get all positions around thresholded crosslinks between -60 and 60
-        # where relative occurence is higher then an arbitrary value (minimal
-        # relative occurence), default 2
-        prtxn = {x: [] for x in rtxn}
-        window_inner = int(window / 3)
-        relevant_pos_inner = list(
-            range(-window_inner + int((kmer_length + 1) / 2), window_inner + 1 + int((kmer_length + 1) / 2)))
-        relevant_pos_outer = list(range(-window + int((kmer_length + 1) / 2), window + 1 + int((kmer_length + 1) / 2)))
-        for i in relevant_pos_outer:
-            if i in relevant_pos_inner:
-                for kmer, posm in rtxn.items():
-                    prtxn[kmer].append(i)
-            else:
-                for kmer, posm in rtxn.items():
-                    if posm[i] > min_relativ_occurence:
-                        prtxn[kmer].append(i)
-        # prepare relevant positions obtained from previous step for output
-        # table and add it to the output table
-        prtxn_concat = {}
-        for key, value in prtxn.items():
-            prtxn_concat[key] = ', '.join([str(i) for i in value])
-        df_prtxn = pd.DataFrame.from_dict(prtxn_concat, orient='index', columns=['prtxn'])
-        df_out = pd.merge(df_out, df_prtxn, left_index=True, right_index=True)
-        prtxn_cp = time.time()
-        # for z-score calculation random samples from crosslink out of peaks
-        # (reference) are used and for each sample we calculate average relative
-        # occurences for each kmer on relevant positions and add them to a list
-        # for calculation of averages and standard deviations
-        random_aroxn = []
-        for _ in range(100):
-            random_seqs = random.sample(reference_sequences, len(sites))
-            random_kmer_pos_count_t = pos_count_kmer(random_seqs, kmer_length, window)
-            random_kmer_pos_count = {key.replace('T', 'U'): value for key, value in random_kmer_pos_count_t.items()}
-            roxn_sample = {x: {} for x in random_kmer_pos_count}
-            for motif, pos_m in random_kmer_pos_count.items():
-                for pos, count in pos_m.items():
-                    try:
-                        roxn_sample[motif][pos] = count / avg_distal_occ[motif]
-                    except ZeroDivisionError:
-                        roxn_sample[motif][pos] = count
-            aroxn_sample = {x: np.mean([roxn_sample[x][y] for y in prtxn[x]]) for x in roxn_sample}
-            random_aroxn.append(aroxn_sample)
-        print(f'Analysing random samples runtime: {((time.time() - prtxn_cp) / 60):.2f} min')
-        # calculate average relative occurences for each kmer around thresholded
-        # crosslinks across relevant positions and add it to outfile table
-        artxn = {x: np.mean([rtxn[x][y] for y in prtxn[x]]) for x in rtxn}
-        df_artxn = pd.DataFrame.from_dict(artxn, orient='index', columns=['artxn'])
-        df_out = pd.merge(df_out, df_artxn, left_index=True, right_index=True)
-        # calculate average relative occurences for each kmer around reference
-        # crosslinks across relevant positions and add it to outfile table
-        aroxn = {x: np.mean([roxn[x][y] for y in prtxn[x]]) for x in roxn}
-        df_aroxn = pd.DataFrame.from_dict(aroxn, orient='index', columns=['aroxn'])
-        df_out = pd.merge(df_out, df_aroxn, left_index=True, right_index=True)
-        # calculate log2 of ratio between average relative occurences between
-        # thresholded and reference crosslinks, this ratio, colaculated for each
-        # kmer is called enrichement and is added to outfile table
-        artxn = {x: artxn[x] for x in artxn if not np.isnan(artxn[x])}
-        etxn = {x: np.log2(artxn[x] / aroxn[x]) for x in artxn}
-        df_etxn = pd.DataFrame.from_dict(etxn, orient='index', columns=['etxn'])
-        df_out = pd.merge(df_out, df_etxn, left_index=True, right_index=True, how='outer')
-        # average relative occurence obtained with random sampling are combined
-        # in a structure that can be then used for calculating averages,
-        # standard deviations and finaly the z-score
-        combined_aroxn = {}
-        for sample in random_aroxn:
-            for key, value in sample.items():
-                values_list = combined_aroxn.get(key, [])
-                values_list.append(value)
-                combined_aroxn[key] = values_list
-        random_avg = {}
-        random_std = {}
-        for key, value in combined_aroxn.items():
-            random_avg[key] = np.mean(value)
-            random_std[key] = np.std(value)
-        z_score = {}
-        for key, value in random_avg.items():
-            try:
-                z_score[key] = (artxn[key] - value) / random_std[key]
-            except KeyError:
-                print(f'Warning: {key} missing from artxn')
-        df_z_score = pd.DataFrame.from_dict(z_score, orient='index', columns=['z-score'])
-        df_out = pd.merge(df_out, df_z_score, left_index=True, right_index=True, how='outer')
-        # using z-score we can also calculate p-values for each motif which are
-        # then added to outfile table
-        df_out['p-value'] = scipy.special.ndtr(-df_out['z-score'])
-        # kmer positional occurences around thresholded crosslinks on positions
-        # around -50 to 50 are also added to outfile table which is then finnaly
-        # written to file
-        # get order of z-scores to select top kmers to plot
-        kmers_order_of_enrichment = get_top_n_kmers(z_score, 4**kmer_length)
-        top_kmers = kmers_order_of_enrichment[:top_n]
-        # normalize kmer occurences by number of thresholded crosslinks for
-        # easier comparison across different samples
-        ntxn = len(sites)
-        kmer_occ_per_txl = {x: {} for x in kmer_pos_count}
-        for motif, pos_m in kmer_pos_count.items():
-            for pos, count in pos_m.items():
-                kmer_occ_per_txl[motif][pos] = count * 100 / ntxn
-        df_kmer_occ_per_txl = pd.DataFrame.from_dict(kmer_occ_per_txl, orient='index')
-        exported_columns = [i for i in range(-48, 51)]
-        df_kmer_occ_per_txl = df_kmer_occ_per_txl[exported_columns]
-        df_out = pd.merge(df_out, df_kmer_occ_per_txl, left_index=True, right_index=True, how='outer')
-        df_out.to_csv(f'./results/{sample_name}_{kmer_length}mer_{region}.tsv', sep='\t', float_format='%.8f')
-        kmer_occ_per_txl_ln = {x: {} for x in kmer_occ_per_txl}
-        for motif, pos_m in kmer_occ_per_txl.items():
-            for pos, count in pos_m.items():
-                if pos in range(-48, 51):
-                    kmer_occ_per_txl_ln[motif][pos] = np.log(count + 1)
-        plot_selection_unsorted = {kmer: values for kmer, values in kmer_occ_per_txl.items() if kmer in top_kmers}
-        plot_selection = {k: plot_selection_unsorted[k] for k in top_kmers}
-        df_smooth, clusters_dict = get_clustering(plot_selection, kmer_occ_per_txl_ln, smoothing, clusters)
-        # for meta analysis clusters are also output in a file
-        with open(f'./results/{sample_name}_{region}_clusters.csv', 'w', newline='') as file:
-            writer = csv.writer(file, lineterminator='\n')
-            for key, val in clusters_dict.items():
-                writer.writerow([key, val])
-        # calculating average occurences for the last plot that displays average
-        # occurences for each cluster over wider window, also output as a file
-        df_cluster_sum = get_cluster_wide_sum(plot_selection, clusters_dict)
-        sum_name = '{}_sum_cluster_distribution_{}.tsv'.format(sample_name, region)
-        # find cluster with max average peak value, rank clusters by this value
-        # and plot clusters in order using thie rank
-        clusters_max = {cluster: max(df_cluster_sum[cluster]) for cluster in df_cluster_sum.columns}
-        clusters_rank = {
-            key: rank for rank, key in enumerate(sorted(clusters_max, key=clusters_max.get, reverse=True), 1)}
-        # using positions and occurences each cluster gets a name
-        cluster_rename = get_clusters_name(clusters_dict)
-        df_cluster_sum.rename(columns=cluster_rename).to_csv('./results/' + sum_name, sep='\t')
-        # finnaly plot all the clusters and the wider window (-150 to 100) plot
-        # with average occurences
-        plot_positional_distribution(
-            df_smooth, df_cluster_sum, clusters_dict, clusters_rank, sample_name, cluster_rename, region)
-        plot_cp = time.time()
-        print(f'Analysing {region} runtime: {((plot_cp - region_start) / 60):.2f}')
-        print(f'Analysing {region} in seconds per thresholded_crosslink: {(plot_cp - region_start) / ntxn}')
+    shared = prepare_shared(genome, genome_fai, regions_file, temp_path, cache_dir=cache_dir)
+    summaries = run_sample(
+        peak_file, sites_file, get_name(sites_file), shared, window, window_distal, kmer_length, top_n, percentile,
+        min_relativ_occurence, clusters, smoothing, all_outputs=all_outputs, regions=regions, seed=seed, null=null,
+        workers=workers, shard_by=shard_by, sparse=sparse, memory_budget=memory_budget, tables=tables)
+    if plots:
+        render_plots([summary['plot_data'] for summary in summaries], workers=workers)
     # cleanup temporary files
-    shutil.rmtree(TEMP_PATH)
-    pbt.cleanup()
+    shutil.rmtree(temp_path)
     print(f'Analysis total runtime {((time.time() - start) / 60):.2f}')
+
+
+def read_manifest(manifest):
+    """Read manifest of samples for batch analysis.
+
+    Manifest is a tab separated file with header and columns peaks, sites
+    and optionally name. If name is not given, it is obtained from the
+    sites file path.
+    """
+    df_manifest = pd.read_csv(manifest, sep='\t', dtype=str)
+    assert {'peaks', 'sites'}.issubset(df_manifest.columns), 'Manifest needs columns peaks and sites.'
+    if 'name' not in df_manifest.columns:
+        df_manifest['name'] = None
+    df_manifest['name'] = [
+        name if isinstance(name, str) else get_name(sites)
+        for name, sites in zip(df_manifest['name'], df_manifest['sites'])]
+    assert df_manifest['name'].is_unique, 'Sample names in manifest are not unique.'
+    return df_manifest[['peaks', 'sites', 'name']]
+
+
+def analyse_sample(sample, context):
+    """Analyse kmers of a sample given as (peaks, sites, name) with parameters in ``context``.
+
+    Errors are caught, so that a failing sample does not stop analysis of
+    other samples, and the sample is reported with its error in summary.
+    """
+    peak_file, sites_file, sample_name = sample
+    sample_start = time.time()
+    try:
+        summaries = run_sample(peak_file, sites_file, sample_name, context['shared'], **context['parameters'])
+    except Exception as error:  # pylint: disable=broad-except
+        traceback.print_exc()
+        print(f'Analysing sample {sample_name} failed: {error!r}')
+        return [{'sample': sample_name, 'error': repr(error)}]
+    print(f'Analysing sample {sample_name} runtime: {((time.time() - sample_start) / 60):.2f} min')
+    return summaries
+
+
+def run_batch(manifest, genome, genome_fai, regions_file, window, window_distal, kmer_length, top_n, percentile,
+              min_relativ_occurence, clusters, smoothing, all_outputs=False, regions=None, seed=None,
+              null='bootstrap', cache_dir=CACHE_DIR, workers=1, shard_by=None, sparse=False,
+              memory_budget=MEMORY_BUDGET, plots=True, tables='tsv'):
+    """Start the analysis of all samples in manifest.
+
+    Genome, regions used for thresholding and chromosome sizes are prepared
+    only once and shared by all samples, which are analysed in ``workers``
+    parallel processes. Results of each sample are written as in ``run``
+    and summaries of all analysed regions of all samples are combined in
+    a table written next to them. Samples that fail are reported with
+    their error in the summary table. For manifest format see
+    ``read_manifest``, for description of other parameters see ``run``.
+    """
+    start = time.time()
+    if regions is None:
+        regions = REGIONS
+    assert set(regions).issubset(set(REGIONS))
+    assert null in NULL_MODELS
+    assert shard_by in SHARD_COLUMNS
+    assert tables in TABLE_FORMATS
+    df_manifest = read_manifest(manifest)
+    temp_path = './TEMP{}/'.format(randint(10 ** 6, 10 ** 7))
+    os.makedirs(temp_path)
+    os.makedirs('./results/', exist_ok=True)
+    context = {
+        'shared': prepare_shared(genome, genome_fai, regions_file, temp_path, cache_dir=cache_dir),
+        'parameters': {
+            'window': window, 'window_distal': window_distal, 'kmer_length': kmer_length, 'top_n': top_n,
+            'percentile': percentile, 'min_relativ_occurence': min_relativ_occurence, 'clusters': clusters,
+            'smoothing': smoothing, 'all_outputs': all_outputs, 'regions': regions, 'seed': seed, 'null': null,
+            'shard_by': shard_by, 'sparse': sparse, 'memory_budget': memory_budget, 'tables': tables},
+    }
+    if cache_dir is not None:
+        # complements of peaks are cached in the parent process, so that
+        # samples with the same peaks do not compute them concurrently
+        # (errors are reported when analysing samples with these peaks)
+        for peak_file in df_manifest['peaks'].unique():
+            try:
+                get_complement_cached(peak_file, context['shared']['chr_sizes'], cache_dir=cache_dir)
+            except Exception:  # pylint: disable=broad-except
+                pass
+    samples = list(df_manifest.itertuples(index=False, name=None))
+    summaries = [summary for sample_summaries in map_tasks(analyse_sample, samples, context, workers=workers)
+                 for summary in sample_summaries]
+    if plots:
+        render_plots([summary['plot_data'] for summary in summaries if 'plot_data' in summary], workers=workers)
+    df_summary = pd.DataFrame(
+        summaries,
+        columns=[
+            'sample', 'region', 'kmer_length', 'ntxn', 'noxn', 'top_kmer', 'top_z_score', 'top_kmers', 'clusters',
+            'error'])
+    # counts stay integers when failed samples have no values
+    df_summary[['kmer_length', 'ntxn', 'noxn']] = df_summary[['kmer_length', 'ntxn', 'noxn']].astype('Int64')
+    manifest_name = os.path.splitext(os.path.basename(manifest))[0]
+    df_summary.to_csv(f'./results/{manifest_name}_summary.tsv', sep='\t', index=False, float_format='%.8f')
+    shutil.rmtree(temp_path)
+    print(f'Analysis of {len(samples)} samples total runtime {((time.time() - start) / 60):.2f}')
+
+
+def parse_clusters(value):
+    """Parse number of clusters given on command line."""
+    return value if value == 'auto' else int(value)
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Analysis of kmers located around locations of interest.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--peaks', help="Intervals of crosslinks (BED6 format).")
+    parser.add_argument('--sites', help="Crosslinks (BED6 format).")
+    parser.add_argument(
+        '--manifest',
+        help="Samples to analyse in batch instead of peaks and sites, tab separated with header peaks, sites, name.")
+    parser.add_argument('--genome', help="Genome (FASTA format).")
+    parser.add_argument('--genome-fai', help="Genome FASTA index file.")
+    parser.add_argument('--regions-file', help="Custom genome segmentation file (GTF format).")
+    parser.add_argument('--window', type=int, default=40, help="Window around crosslinks for positional counts.")
+    parser.add_argument('--window-distal', type=int, default=150, help="Window for background distribution.")
+    parser.add_argument('--kmer-length', type=int, nargs='+', default=4, help="Length(s) of kmers.")
+    parser.add_argument('--top-n', type=int, default=20, help="Number of top kmers for clustering and plotting.")
+    parser.add_argument('--percentile', type=float, default=0.7, help="Percentile for thresholding crosslinks.")
+    parser.add_argument(
+        '--min-relative-occurence', type=float, default=2,
+        help="Minimal ratio of occurences around crosslinks to distal occurences.")
+    parser.add_argument(
+        '--clusters', type=parse_clusters, default=5,
+        help="Number of clusters of kmers, 'auto' to choose it by silhouette score.")
+    parser.add_argument('--smoothing', type=int, default=6, help="Window for smoothing positional distributions.")
+    parser.add_argument('--all-outputs', action='store_true', help="Produce all outputs.")
+    parser.add_argument(
+        '--regions', default=None,
+        help="Regions to analyse, separated by comma. If not given, all regions are analysed.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for random samples of reference crosslinks.")
+    parser.add_argument('--null', choices=NULL_MODELS, default='bootstrap', help="Null model for z-scores.")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help="Directory for caching results across runs.")
+    parser.add_argument('--no-cache', action='store_true', help="Do not cache results across runs.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes for analysing regions or samples.")
+    parser.add_argument(
+        '--shard-by', choices=SHARD_COLUMNS[1:], default=None,
+        help="Split crosslinks of features into shards that are counted separately.")
+    parser.add_argument('--sparse', action='store_true', help="Analyse only kmers present around crosslinks.")
+    parser.add_argument(
+        '--memory-budget', type=int, default=MEMORY_BUDGET // 2 ** 20,
+        help="Memory (in MiB) used for reading crosslinks in chunks.")
+    parser.add_argument(
+        '--tables', choices=TABLE_FORMATS, default='tsv',
+        help="Format of tables of kmer results, binary tables are float32 arrays with integer kmer codes.")
+    parser.add_argument(
+        '--no-plots', action='store_true', help="Only write data of plots, which can be drawn with --render-plots.")
+    parser.add_argument(
+        '--render-plots', action='store_true',
+        help="Draw plots from data in results directory written by previous runs and exit.")
+    args = parser.parse_args()
+    if args.render_plots:
+        return args
+    if args.genome is None or args.genome_fai is None or args.regions_file is None:
+        parser.error('--genome, --genome-fai and --regions-file are required')
+    if args.manifest is None and (args.peaks is None or args.sites is None):
+        parser.error('either --manifest or both --peaks and --sites are required')
+    return args
+
+
+def main():
+    """Invoke when run directly as a program."""
+    args = parse_arguments()
+    if args.render_plots:
+        render_plots(workers=args.workers)
+        return
+    regions = args.regions.split(',') if args.regions else None
+    cache_dir = None if args.no_cache else args.cache_dir
+    if args.manifest:
+        run_batch(
+            args.manifest, args.genome, args.genome_fai, args.regions_file, args.window, args.window_distal,
+            args.kmer_length, args.top_n, args.percentile, args.min_relative_occurence, args.clusters,
+            args.smoothing, all_outputs=args.all_outputs, regions=regions, seed=args.seed, null=args.null,
+            cache_dir=cache_dir, workers=args.workers, shard_by=args.shard_by, sparse=args.sparse,
+            memory_budget=args.memory_budget * 2 ** 20, plots=not args.no_plots, tables=args.tables)
+        return
+    run(
+        args.peaks, args.sites, args.genome, args.genome_fai, args.regions_file, args.window, args.window_distal,
+        args.kmer_length, args.top_n, args.percentile, args.min_relative_occurence, args.clusters, args.smoothing,
+        all_outputs=args.all_outputs, regions=regions, seed=args.seed, null=args.null, cache_dir=cache_dir,
+        workers=args.workers, shard_by=args.shard_by, sparse=args.sparse,
+        memory_budget=args.memory_budget * 2 ** 20, plots=not args.no_plots, tables=args.tables)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+"""Test kmers analysis."""
+# pylint: disable=missing-docstring
+import os
+import shutil
+import tempfile
+import unittest
+from functools import partial
+from itertools import product
+
+import numpy as np
+import pandas as pd
+from imaps.sandbox.kmers import (
+    CHUNK_SIZE, SITE_BYTES, STRANDS, annotate_sites, get_analytic_aroxn, get_annotation_index, get_bed_store,
+    get_complement, get_genome_store, get_group_quantiles, get_kmer_stats, get_positions, get_relevant_window_codes,
+    get_sparse_rows, get_top_n_indices, get_windows, merge_runs, pos_count_encoded_lengths, pos_count_kmer,
+    pos_count_matrix,
+)
+
+
+class TestGetTopNIndices(unittest.TestCase):
+
+    def test_ties_at_cutoff(self):
+        values = np.array([5] * 10 + [1] * 5 + [5] * 10, dtype=float)
+        np.testing.assert_array_equal(get_top_n_indices(values, 12), list(range(10)) + [15, 16])
+
+    def test_order(self):
+        values = np.array([1, np.nan, 3, np.inf, 3, 2, np.nan])
+        np.testing.assert_array_equal(get_top_n_indices(values, 5), [3, 2, 4, 5, 0])
+        np.testing.assert_array_equal(get_top_n_indices(values, 10), [3, 2, 4, 5, 0, 1, 6])
+        self.assertEqual(len(get_top_n_indices(values, 0)), 0)
+
+    def test_same_as_sorting(self):
+        rng = np.random.RandomState(0)
+        for _ in range(100):
+            values = rng.choice([0, 1, 2, np.inf, np.nan], size=rng.randint(1, 50))
+            num = rng.randint(0, 60)
+            expected = np.lexsort((np.arange(len(values)), -np.where(np.isnan(values), -np.inf, values)))[:num]
+            np.testing.assert_array_equal(get_top_n_indices(values, num), expected)
+
+
+class TestPosCountKmer(unittest.TestCase):
+
+    @staticmethod
+    def count_loop(seqs, k_length, window, kmers):
+        """Count kmers on each position with a loop over sequence strings."""
+        shift = int((k_length + 1) / 2)
+        pos_count = {kmer: {pos: 0 for pos in range(-window + shift, window + shift + 1)} for kmer in kmers}
+        for sequence in seqs:
+            for i in range(k_length, len(sequence) - k_length):
+                kmer = sequence[i: i + k_length]
+                if kmer in pos_count:
+                    pos_count[kmer][i - window - k_length + shift] += 1
+        return pos_count
+
+    def get_sequences(self, k_length):
+        """Return random sequences of full window length and shorter, with N and lowercase bases."""
+        rng = np.random.RandomState(k_length)
+        full = 2 * (self.window + k_length) + 1
+        lengths = [full] * 50 + [0, k_length, 2 * k_length, 2 * k_length + 1, full - k_length, full - 1]
+        return [''.join(rng.choice(list('ACGTACGTACGTNacgt'), size=length)) for length in lengths]
+
+    def setUp(self):
+        self.window = 6
+
+    def test_same_as_loop(self):
+        for k_length in [1, 3, 4]:
+            seqs = self.get_sequences(k_length)
+            kmers = [''.join(kmer) for kmer in product('ACGT', repeat=k_length)]
+            expected = self.count_loop(seqs, k_length, self.window, kmers)
+            self.assertEqual(pos_count_kmer(seqs, k_length, self.window), expected)
+            np.testing.assert_array_equal(
+                pos_count_matrix(seqs, k_length, self.window), [list(expected[kmer].values()) for kmer in kmers])
+
+    def test_kmer_list(self):
+        seqs = self.get_sequences(3)
+        kmers = ['TTT', 'ACG', 'GAT']
+        self.assertEqual(
+            pos_count_kmer(seqs, 3, self.window, kmer_list=kmers), self.count_loop(seqs, 3, self.window, kmers))
+
+
+class TestPosCountEncodedLengths(unittest.TestCase):
+
+    def test_sparse_same_as_dense(self):
+        rng = np.random.RandomState(0)
+        window = 5
+        encoded = rng.randint(0, 5, size=(3 * CHUNK_SIZE + 7, 2 * (window + 3) + 1)).astype(np.uint8)
+        dense = pos_count_encoded_lengths(encoded, [2, 3], window)
+        sparse = pos_count_encoded_lengths(encoded, [2, 3], window, sparse=True)
+        for k_length in [2, 3]:
+            np.testing.assert_array_equal(
+                get_sparse_rows(sparse[k_length], np.arange(4 ** k_length), 2 * window + 1), dense[k_length])
+
+
+class TestGetAnalyticAroxn(unittest.TestCase):
+
+    def test_sample_larger_than_reference(self):
+        window, k_length = 2, 2
+        ref_windows = np.zeros((3, 2 * (window + k_length) + 1), dtype=np.uint8)
+        relevant_codes = partial(
+            get_relevant_window_codes, k_length=k_length, window=window,
+            prtxn_mask=np.ones((4 ** k_length, 2 * window + 1), dtype=bool))
+        norm = np.ones(4 ** k_length)
+        avg, std = get_analytic_aroxn(ref_windows, relevant_codes, 3, norm)
+        self.assertEqual(avg[0], 15)
+        np.testing.assert_array_equal(std, 0)
+        with self.assertRaises(ValueError):
+            get_analytic_aroxn(ref_windows, relevant_codes, 4, norm)
+
+
+class TestGetKmerStats(unittest.TestCase):
+
+    @staticmethod
+    def get_stats_dicts(counts, ref_counts, ntxn, noxn, k_length, window, window_distal, min_relativ_occurence):
+        """Calculate kmer statistics with dictionaries of positional counts of each kmer."""
+        shift = int((k_length + 1) / 2)
+        pos_count = [dict(zip(get_positions(k_length, window_distal), row)) for row in counts.tolist()]
+        ref_pos_count = [dict(zip(get_positions(k_length, window), row)) for row in ref_counts.tolist()]
+        stats = {'mtxn': [], 'distal_occ': [], 'prtxn': [], 'artxn': [], 'aroxn': []}
+        for pos_c, ref_pos_c in zip(pos_count, ref_pos_count):
+            peak = {pos: pos_c[pos] for pos in range(-15, 16)}
+            stats['mtxn'].append(max(peak, key=peak.get))
+            distal = [count for pos, count in pos_c.items() if pos not in range(-100 + shift, 100 + shift)]
+            distal_occ = sum(distal) / len(distal)
+            stats['distal_occ'].append(distal_occ)
+            rtxn = {pos: count / distal_occ if distal_occ else count for pos, count in pos_c.items()}
+            roxn = {
+                pos: count * ntxn / (distal_occ * noxn) if distal_occ else count * ntxn / noxn
+                for pos, count in ref_pos_c.items()}
+            window_inner = int(window / 3)
+            prtxn = [
+                pos for pos in get_positions(k_length, window)
+                if pos in range(-window_inner + shift, window_inner + 1 + shift) or rtxn[pos] > min_relativ_occurence]
+            stats['prtxn'].append(prtxn)
+            stats['artxn'].append(np.mean([rtxn[pos] for pos in prtxn]))
+            stats['aroxn'].append(np.mean([roxn[pos] for pos in prtxn]))
+        return stats
+
+    def test_same_as_dicts(self):
+        rng = np.random.RandomState(0)
+        k_length, window, window_distal = 4, 20, 110
+        counts = rng.poisson(0.5, size=(200, 2 * window_distal + 1))
+        counts[:20, :10] = 0
+        counts[:20, -15:] = 0
+        ref_counts = rng.poisson(2, size=(200, 2 * window + 1))
+        stats = get_kmer_stats(counts, ref_counts, 300, 1000, k_length, window, window_distal, 2, [-2, 0, 5])
+        expected = self.get_stats_dicts(counts, ref_counts, 300, 1000, k_length, window, window_distal, 2)
+        self.assertIn(0, expected['distal_occ'])
+        np.testing.assert_array_equal(stats['mtxn'], expected['mtxn'])
+        np.testing.assert_allclose(stats['distal_occ'], expected['distal_occ'])
+        positions = np.array(get_positions(k_length, window))
+        self.assertEqual([positions[mask].tolist() for mask in stats['prtxn_mask']], expected['prtxn'])
+        np.testing.assert_allclose(stats['artxn'], expected['artxn'])
+        np.testing.assert_allclose(stats['aroxn'], expected['aroxn'])
+        np.testing.assert_allclose(stats['etxn'], np.log2(np.array(expected['artxn']) / expected['aroxn']))
+        positions_distal = get_positions(k_length, window_distal)
+        np.testing.assert_allclose(
+            stats['occ'], counts[:, [positions_distal.index(pos) for pos in [-2, 0, 5]]] * 100 / 300)
+
+
+class TestGetGroupQuantiles(unittest.TestCase):
+
+    def test_same_as_groupby(self):
+        rng = np.random.RandomState(0)
+        groups = rng.randint(-1, 20, size=1000)
+        values = rng.randint(0, 10, size=1000).astype(float)
+        values[rng.rand(1000) < 0.05] = np.nan
+        for percentile in [0, 0.3, 0.7, 1]:
+            df_in = pd.DataFrame({'group': groups, 'value': values})
+            df_quantiles = df_in[groups >= 0].groupby('group')['value'].quantile(percentile)
+            expected = np.where(np.isnan(values), np.nan, df_quantiles.reindex(groups).values)
+            np.testing.assert_allclose(get_group_quantiles(groups, values, percentile), expected)
+
+    def test_empty_groups(self):
+        quantiles = get_group_quantiles([2, 2, -1, 2, 5], [1, 3, 4, 2, 7], 0.5)
+        np.testing.assert_array_equal(quantiles, [2, 2, np.nan, 2, 7])
+        self.assertTrue(np.isnan(get_group_quantiles([-1], [1], 0.5)).all())
+
+
+class TestAnnotateSites(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_boundaries(self):
+        regions_file = os.path.join(self.temp_dir, 'regions.gtf')
+        regions = [
+            ['chr1', 'intron', 101, 400, '+', 'a', 'A'],
+            ['chr1', 'intron', 501, 550, '+', 'a', 'A'],
+            ['chr1', 'CDS', 1001, 1200, '+', 'b', 'B'],
+            ['chr1', 'UTR3', 2001, 2099, '-', 'c', 'C'],
+            ['chr1', 'UTR3', 3001, 3200, '-', 'c', 'C'],
+            ['chr2', 'ncRNA', 11, 30, '+', 'd', 'D'],
+            ['chr2', 'intergenic', 501, 900, '-', 'e', 'E'],
+        ]
+        pd.DataFrame([
+            [chrom, '.', region, start, end, '.', strand, '.', f'gene_id "{gene_id}";gene_name "{name}";x']
+            for chrom, region, start, end, strand, gene_id, name in regions
+        ]).to_csv(regions_file, sep='\t', header=False, index=False)
+        sites = [
+            # intron [101, 400), 0-based
+            ('chr1', 100, '+'), ('chr1', 101, '+'), ('chr1', 399, '+'), ('chr1', 400, '+'), ('chr1', 101, '-'),
+            # intron shorter than 100 is removed
+            ('chr1', 520, '+'),
+            # CDS [1000, 1200) trimmed by 30
+            ('chr1', 1029, '+'), ('chr1', 1030, '+'), ('chr1', 1169, '+'), ('chr1', 1170, '+'),
+            # UTR3 shorter than 100 is removed, UTR3 [3000, 3200)
+            ('chr1', 2050, '-'), ('chr1', 2999, '-'), ('chr1', 3000, '-'), ('chr1', 3199, '-'), ('chr1', 3200, '-'),
+            ('chr1', 3000, '+'),
+            # ncRNA [10, 30) is kept regardless of size, intergenic [501, 900)
+            ('chr2', 9, '+'), ('chr2', 10, '+'), ('chr2', 29, '+'), ('chr2', 30, '+'),
+            ('chr2', 500, '-'), ('chr2', 501, '-'), ('chr2', 899, '-'), ('chr2', 900, '-'),
+            ('chr3', 101, '+'),
+        ]
+        df_sites = pd.DataFrame(sites + [('chr1', 101, '+')], columns=['chrom', 'start', 'strand'])
+        df_sites['end'] = df_sites['start'] + 1
+        df_sites['name'] = '.'
+        df_sites['score'] = np.arange(len(df_sites)) + 1.0
+
+        df_annotated = annotate_sites(df_sites, get_annotation_index(regions_file, cache_dir=self.temp_dir))
+
+        annotated = sorted(
+            (row.family, row.feature, row.chrom, row.start, row.end, row.strand, row.name, row.score)
+            for row in df_annotated.itertuples())
+        self.assertEqual(annotated, sorted([
+            ('cds_utr_ncrna', 'CDS', 'chr1', 1030, 1031, '+', 'B', 8.0),
+            ('cds_utr_ncrna', 'CDS', 'chr1', 1169, 1170, '+', 'B', 9.0),
+            ('cds_utr_ncrna', 'UTR3', 'chr1', 3000, 3001, '-', 'C', 13.0),
+            ('cds_utr_ncrna', 'UTR3', 'chr1', 3199, 3200, '-', 'C', 14.0),
+            ('cds_utr_ncrna', 'ncRNA', 'chr2', 10, 11, '+', 'D', 18.0),
+            ('cds_utr_ncrna', 'ncRNA', 'chr2', 29, 30, '+', 'D', 19.0),
+            ('intergenic', 'intergenic', 'chr2', 501, 502, '-', '.', 22.0),
+            ('intergenic', 'intergenic', 'chr2', 899, 900, '-', '.', 23.0),
+            # repeated crosslink has summed score
+            ('intron', 'intron', 'chr1', 101, 102, '+', '.', 2.0 + 26.0),
+            ('intron', 'intron', 'chr1', 399, 400, '+', '.', 3.0),
+        ]))
+
+
+class TestGetWindows(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_same_as_slicing(self):
+        rng = np.random.RandomState(0)
+        genome = {
+            chrom: ''.join(rng.choice(list('ACGTACGTNacgt'), size=size))
+            for chrom, size in [('chr1', 30), ('chr2', 23), ('chrM', 5)]}
+        fasta = os.path.join(self.temp_dir, 'genome.fa')
+        line_bases = 7
+        index = []
+        with open(fasta, 'w') as file:
+            for chrom, sequence in genome.items():
+                file.write(f'>{chrom}\n')
+                index.append([chrom, len(sequence), file.tell(), line_bases, line_bases + 1])
+                for i in range(0, len(sequence), line_bases):
+                    file.write(sequence[i:i + line_bases] + '\n')
+        pd.DataFrame(index).to_csv(fasta + '.fai', sep='\t', header=False, index=False)
+        genome_store = get_genome_store(fasta, fasta + '.fai', cache_dir=self.temp_dir)
+
+        sites = [
+            (chrom, position, strand) for chrom in ['chr1', 'chr2', 'chrM', 'chrUn'] for position in [0, 2, 4, 12, 22]
+            for strand in STRANDS]
+        chroms, positions, strands = zip(*sites)
+        windows = get_windows(genome_store, chroms, positions, strands, 4, 3)
+
+        complement = str.maketrans('ACGTN-', 'TGCAN-')
+        expected = []
+        for chrom, position, strand in sites:
+            padded = '-' * 4 + ''.join(
+                base if base in 'ACGT' else 'N' for base in genome.get(chrom, '')) + '-' * 30
+            window = padded[position:position + 8]
+            expected.append(window[::-1].translate(complement) if strand == '-' else window)
+        self.assertEqual([''.join(np.array(list('ACGTN-'))[window]) for window in windows], expected)
+
+
+class TestMergeRuns(unittest.TestCase):
+
+    def test_same_as_stable_sort(self):
+        rng = np.random.RandomState(0)
+        runs = [np.sort(rng.randint(0, 20, size=size)) for size in [0, 1, 7, 30, 30, 55]]
+        expected = np.argsort(np.concatenate(runs), kind='mergesort')
+        offsets = np.cumsum([0] + [len(run) for run in runs])
+        for block_size in [1, 3, 100]:
+            merged = np.concatenate([offsets[run_ids] + indices for run_ids, indices in merge_runs(runs, block_size)])
+            np.testing.assert_array_equal(merged, expected)
+
+
+class TestGetBedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        size = 500
+        self.df_bed = pd.DataFrame({
+            'chrom': rng.choice(['chr2', 'chr10', 'chr1', 'chrX'], size=size),
+            'start': rng.randint(0, 100, size=size),
+            'name': rng.choice(['a', 'b', 'c'], size=size),
+            'score': rng.randint(1, 10, size=size).astype(float),
+            'strand': rng.choice(['+', '-'], size=size),
+        })
+        self.df_bed.insert(2, 'end', self.df_bed['start'] + 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assert_store_sorted(self, bed_file, memory_budget):
+        store = get_bed_store(bed_file, cache_dir=self.temp_dir, memory_budget=memory_budget)
+        df_expected = self.df_bed.sort_values(by=['chrom', 'start', 'strand'], kind='mergesort')
+        chrom_codes = np.repeat(np.arange(len(store['chroms'])), np.diff(store['chrom_offsets']))
+        np.testing.assert_array_equal(store['chroms'][chrom_codes], df_expected['chrom'])
+        np.testing.assert_array_equal(store['start'], df_expected['start'])
+        np.testing.assert_array_equal(store['end'], df_expected['end'])
+        np.testing.assert_array_equal(store['names'][store['name_codes']], df_expected['name'])
+        np.testing.assert_array_equal(store['score'], df_expected['score'])
+        np.testing.assert_array_equal(store['strands'][store['strand_codes']], df_expected['strand'])
+
+    def test_several_runs(self):
+        bed_file = os.path.join(self.temp_dir, 'sites.bed')
+        self.df_bed.to_csv(bed_file, sep='\t', header=False, index=False)
+        self.assert_store_sorted(bed_file, 37 * SITE_BYTES)
+
+    def test_presorted(self):
+        bed_file = os.path.join(self.temp_dir, 'sites.bed')
+        self.df_bed.sort_values(by=['chrom', 'start', 'strand'], kind='mergesort').to_csv(
+            bed_file, sep='\t', header=False, index=False)
+        self.assert_store_sorted(bed_file, 37 * SITE_BYTES)
+
+    def test_sorted_runs(self):
+        bed_file = os.path.join(self.temp_dir, 'sites.bed')
+        df_runs = self.df_bed.groupby(np.arange(len(self.df_bed)) // 37, group_keys=False).apply(
+            lambda df_run: df_run.sort_values(by=['chrom', 'start', 'strand'], kind='mergesort'))
+        df_runs.to_csv(bed_file, sep='\t', header=False, index=False)
+        self.assert_store_sorted(bed_file, 37 * SITE_BYTES)
+
+    def test_gzipped(self):
+        bed_file = os.path.join(self.temp_dir, 'sites.bed.gz')
+        self.df_bed.to_csv(bed_file, sep='\t', header=False, index=False, compression='gzip')
+        self.assert_store_sorted(bed_file, 37 * SITE_BYTES)
+        self.assert_store_sorted(bed_file, 37 * SITE_BYTES)
+
+
+class TestGetComplement(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def get_gaps(covered):
+        """Return (start, end) of runs of positions that are not covered."""
+        edges = np.diff(np.concatenate([[0], (~covered).astype(int), [0]]))
+        return list(zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]))
+
+    def test_same_as_gap_scan(self):
+        rng = np.random.RandomState(0)
+        chrom_sizes = {'chr1': 300, 'chr2': 50, 'chrM': 100, 'chr3': 80}
+        size = 200
+        df_peaks = pd.DataFrame({
+            'chrom': rng.choice(['chr1', 'chr2', 'chrM', 'chrUn'], size=size),
+            'start': rng.randint(0, 320, size=size),
+            'name': '.',
+            'score': 1,
+            'strand': rng.choice(['+', '-', '.'], size=size),
+        })
+        df_peaks.insert(2, 'end', df_peaks['start'] + rng.randint(1, 15, size=size))
+        peak_file = os.path.join(self.temp_dir, 'peaks.bed')
+        df_peaks.to_csv(peak_file, sep='\t', header=False, index=False)
+        chrsizes_file = os.path.join(self.temp_dir, 'genome.txt')
+        pd.Series(chrom_sizes).to_csv(chrsizes_file, sep='\t', header=False)
+
+        complement = get_complement(peak_file, chrsizes_file, cache_dir=self.temp_dir)
+
+        groups = complement['start_keys'] // 2 ** 32
+        np.testing.assert_array_equal(groups, complement['end_keys'] // 2 ** 32)
+        gaps = list(zip(
+            complement['chroms'][groups // len(STRANDS)], np.array(STRANDS)[groups % len(STRANDS)],
+            complement['start_keys'] % 2 ** 32, complement['end_keys'] % 2 ** 32))
+        expected = []
+        for chrom in sorted(chrom_sizes):
+            for strand in STRANDS:
+                covered = np.zeros(chrom_sizes[chrom], dtype=bool)
+                if chrom != 'chrM':
+                    for _, peak in df_peaks[(df_peaks['chrom'] == chrom) & (df_peaks['strand'] == strand)].iterrows():
+                        covered[peak['start']:peak['end']] = True
+                expected.extend((chrom, strand, start, end) for start, end in self.get_gaps(covered))
+        self.assertEqual(gaps, expected)